@@ -1,14 +1,17 @@
 import os
+import signal
+import hashlib
 import logging
 import asyncio
-from threading import Thread
 
-from flask import Flask
-from telegram.ext import Application
 from dotenv import load_dotenv
 
 from bot.core import create_bot_application
-from bot.utils.db import init_database
+from bot.utils.db import init_database, close_database
+from bot.utils.broadcast import stop_all as stop_broadcasts
+from bot.utils.sharding import start_shard_pool, stop_shard_pool
+from bot.utils.profiling import loop_monitor
+from bot.web import WebServer, health_check, metrics_handler, webhook_handler
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -18,27 +21,34 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# --- Flask App for Health Checks (for Koyeb) ---
-flask_app = Flask(__name__)
-
-@flask_app.route('/')
-def health_check():
-    """Provides a simple health check endpoint for deployment platforms."""
-    return "Relay bot is running.", 200
+WEBHOOK_PATH = "/telegram"
+ALLOWED_UPDATES = ['message', 'callback_query']
 
 # --- Main Bot Logic ---
 async def main():
-    """Initializes and runs the Telegram bot."""
+    """Initializes and runs the Telegram bot and its web server on a single event loop."""
     logger.info("Starting bot initialization...")
-    
+
     load_dotenv()
 
+    # --- Health Checks (for Koyeb) ---
+    # Started first so the platform sees the service as alive while the bot initializes.
+    web_server = WebServer(port=int(os.environ.get('PORT', 8080)))
+    web_server.route('GET', '/', health_check)
+    await web_server.start()
+    loop_monitor.start()
+
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop_event.set)
+
     # --- Configuration Validation ---
     bot_token = os.getenv("BOT_TOKEN", "")
     mongo_uri = os.getenv("MONGO_URI", "")
     db_name = os.getenv("MONGO_DB_NAME", "telegram_relay_bot")
     approval_channel_id = os.getenv("APPROVAL_CHANNEL_ID", "")
     admin_ids_str = os.getenv("INITIAL_ADMIN_IDS", "7959714788")
+    webhook_url = os.getenv("WEBHOOK_URL", "")
 
     required_vars = {
         "BOT_TOKEN": bot_token,
@@ -51,6 +61,7 @@ async def main():
     missing_vars = [key for key, value in required_vars.items() if not value]
     if missing_vars:
         logger.critical(f"FATAL: Missing critical environment variables: {', '.join(missing_vars)}")
+        await web_server.stop()
         return
 
     # --- Database Initialization ---
@@ -60,40 +71,51 @@ async def main():
         logger.info("Database connection successful.")
     except Exception as e:
         logger.critical(f"FATAL: Could not connect to MongoDB. Error: {e}", exc_info=True)
+        await web_server.stop()
         return
 
     # --- Bot Application Setup ---
     logger.info("Creating bot application...")
     application = create_bot_application(bot_token)
-    
-    logger.info("Bot setup complete. Starting polling...")
-    
+    web_server.route('GET', '/metrics', metrics_handler(application, os.getenv("METRICS_TOKEN", "")))
+    start_shard_pool(bot_token)
+
     try:
         await application.initialize()
         await application.start()
-        await application.updater.start_polling(allowed_updates=['message', 'callback_query'])
-        logger.info("Bot is now running and polling for updates.")
-        # This will keep the application running indefinitely
-        await asyncio.Event().wait()
+        if webhook_url:
+            # Telegram only accepts A-Z, a-z, 0-9, _ and - in the secret token.
+            secret_token = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(bot_token.encode()).hexdigest()[:32]
+            web_server.route('POST', WEBHOOK_PATH, webhook_handler(application, secret_token))
+            try:
+                await application.bot.set_webhook(
+                    url=webhook_url.rstrip('/') + WEBHOOK_PATH, secret_token=secret_token,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                logger.info("Bot is now running and receiving updates by webhook.")
+            except Exception as e:
+                logger.error(f"Could not register the webhook with Telegram: {e}. Serving {WEBHOOK_PATH} anyway.")
+        else:
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+            logger.info("WEBHOOK_URL not set: bot is now running and polling for updates.")
+        await stop_event.wait()
     except Exception as e:
         logger.critical(f"An error occurred while running the bot: {e}", exc_info=True)
     finally:
-        await application.updater.stop()
-        await application.stop()
+        await stop_broadcasts()
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await web_server.stop()
+        await loop_monitor.stop()
+        await stop_shard_pool()
+        await close_database()
+        await application.shutdown()
         logger.info("Bot has been stopped.")
 
 
-def run_flask():
-    """Runs the Flask app in a separate thread."""
-    port = int(os.environ.get('PORT', 8080))
-    flask_app.run(host='0.0.0.0', port=port)
-
 if __name__ == '__main__':
-    # Run Flask in a background thread for health checks
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-
-    # Run the main async bot function
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
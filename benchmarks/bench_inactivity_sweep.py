@@ -0,0 +1,154 @@
+"""
+Times the inactivity sweep against a scratch MongoDB database seeded with
+synthetic users, and compares the bulk demotion with the old one
+update_one per user.
+
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.bench_inactivity_sweep --users 100000
+
+Without a server, --fake-mongo runs it against the in-process stand-in from
+benchmarks.fake_mongo (needs mongomock) and reports the database operations
+of each phase. Its timings say nothing about a real server.
+
+The scratch database (--db, default bench_inactivity_sweep) is dropped
+before and after the run. Notices go through the real fan-out to a local
+fake Bot API server, with rate limits lifted, so that part measures the
+bot's own overhead rather than Telegram's 30 msg/s cap.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+
+from telegram.ext import ExtBot
+
+from bot.utils import db
+from bot.utils.delivery import fan_out
+from bot.utils.rate_limiter import RelayRateLimiter
+
+TOKEN = "123:fake"
+UNLIMITED = 1_000_000
+SEED_BATCH = 10000
+
+
+async def seed(database, users: int, qualified_share: float):
+    now = datetime.utcnow()
+    joined = now - timedelta(days=30)
+    rng = random.Random(0)
+    for start in range(0, users, SEED_BATCH):
+        user_docs, buckets = [], []
+        for user_id in range(start + 1, min(start + SEED_BATCH, users) + 1):
+            user_docs.append({
+                'user_id': user_id, 'full_name': f"User {user_id}", 'username': f"user{user_id}", 'status': 'active',
+                'is_admin': False, 'is_whitelisted': False, 'join_date': joined,
+                'last_active': now - timedelta(hours=rng.randint(0, 24 * 14)),
+                'media_sent_count': 0, 'total_messages_sent': 0,
+            })
+            if rng.random() < qualified_share:
+                buckets.append({'user_id': user_id, 'hour': (now - timedelta(days=1)).replace(minute=0, second=0, microsecond=0),
+                                'media_sent_count': 30, 'total_messages_sent': 30})
+        await database.users.insert_many(user_docs, ordered=False)
+        if buckets:
+            await database.activity_hourly.insert_many(buckets, ordered=False)
+    await database.config.update_one({'_id': 'activity_buckets_since'},
+                                     {'$set': {'value': now - timedelta(days=60)}}, upsert=True)
+
+
+async def per_user_baseline(user_ids) -> float:
+    """The sweep as it used to be: one update per user."""
+    started = time.perf_counter()
+    for user_id in user_ids:
+        await db.update_user_status(user_id, 'inactive')
+    return time.perf_counter() - started
+
+
+def operations() -> dict:
+    """Operations counted by the in-process stand-in so far, if it is in use."""
+    if db.AsyncIOMotorClient.__name__ != "FakeMotorClient":
+        return {}
+    return dict(db.AsyncIOMotorClient.operations)
+
+
+def operations_since(before: dict) -> dict:
+    after = operations()
+    return {key: after[key] - before.get(key, 0) for key in sorted(after) if after[key] != before.get(key, 0)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--qualified-share", type=float, default=0.3, help="share of users with enough media")
+    parser.add_argument("--baseline-sample", type=int, default=2000, help="users demoted one by one for comparison")
+    parser.add_argument("--db", default="bench_inactivity_sweep")
+    parser.add_argument("--port", type=int, default=8093)
+    parser.add_argument("--no-notices", action="store_true")
+    parser.add_argument("--fake-mongo", action="store_true", help="use the in-process MongoDB stand-in")
+    args = parser.parse_args()
+
+    if args.fake_mongo:
+        from benchmarks.fake_mongo import FakeMotorClient
+        db.AsyncIOMotorClient = FakeMotorClient
+        mongo_uri = "mongodb://in-process"
+    else:
+        mongo_uri = os.environ["MONGO_URI"]
+    report = {"users": args.users, "fake_mongo": args.fake_mongo}
+    phase_operations = {}
+    await db.init_database(mongo_uri, args.db, "0")
+    database = db.db
+    server = None
+    try:
+        await database.users.delete_many({})
+        await database.activity_hourly.delete_many({})
+        started = time.perf_counter()
+        await seed(database, args.users, args.qualified_share)
+        await db.active_roster.load(database.users)
+        report["seed_s"] = round(time.perf_counter() - started, 2)
+
+        started, before = time.perf_counter(), operations()
+        inactive_ids = [user['user_id'] for user in await db.find_inactive_users(days=7, min_media=25)]
+        report["find_inactive_s"] = round(time.perf_counter() - started, 3)
+        phase_operations["find_inactive"] = operations_since(before)
+        report["inactive"] = len(inactive_ids)
+
+        sample, rest = inactive_ids[:args.baseline_sample], inactive_ids[args.baseline_sample:]
+        before = operations()
+        baseline = await per_user_baseline(sample)
+        report["per_user_update_per_s"] = round(len(sample) / baseline, 1) if baseline else None
+        phase_operations[f"per_user_baseline ({len(sample)} users)"] = operations_since(before)
+
+        started, before = time.perf_counter(), operations()
+        report["bulk_deactivated"] = await db.deactivate_users(rest)
+        phase_operations[f"bulk_deactivate ({len(rest)} users)"] = operations_since(before)
+        bulk = time.perf_counter() - started
+        report["bulk_deactivate_s"] = round(bulk, 3)
+        report["bulk_update_per_s"] = round(len(rest) / bulk, 1) if bulk else None
+        report["roster_after"] = len(db.active_roster)
+
+        if not args.no_notices:
+            server = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_bot_api", "--port", str(args.port),
+                                       "--token", TOKEN])
+            await asyncio.sleep(1.5)
+            bot = ExtBot(TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot",
+                         rate_limiter=RelayRateLimiter(global_rate=UNLIMITED, per_chat_burst=UNLIMITED))
+            await bot.initialize()
+            result = await fan_out(inactive_ids, lambda chat_id: bot.send_message(chat_id, "You have been marked as inactive."),
+                                   label="bench inactivity notice", demote_forbidden=False)
+            await bot.shutdown()
+            report["notices"] = {"sent": result.sent, "failed": result.failed,
+                                 "elapsed_s": round(result.elapsed, 2), "per_s": round(result.rate, 1)}
+        if args.fake_mongo:
+            report["db_operations"] = phase_operations
+    finally:
+        if server:
+            server.terminate()
+        await db.client.drop_database(args.db)
+        await db.close_database()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
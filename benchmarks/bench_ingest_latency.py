@@ -0,0 +1,160 @@
+"""
+Compares ingest-to-first-delivery latency of the old fixed 15-second poll of
+the media buffer with the event-driven MediaDispatcher.
+
+    python -m benchmarks.bench_ingest_latency --senders 50 --duration 300
+
+Both models run the real MediaGroupAssembler on the same synthetic stream of
+single photos and albums; only the step from "buffered" to "relay started"
+differs. The relay itself is simulated with a fixed --relay-ms delay before
+the first copy goes out. Time is compressed by --scale so a run takes
+duration * scale seconds per model; all reported times are unscaled.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from types import SimpleNamespace
+
+from bot.utils import media_dispatch, media_groups
+from bot.utils.media_dispatch import MediaDispatcher
+from bot.utils.media_groups import MediaGroupAssembler
+
+POLL_INTERVAL = 15
+POLL_RUN_ONCE_DELAY = 1
+
+
+def workload(senders: int, duration: float, rate: float, album_share: float, seed: int = 0):
+    """(at, sender_id, media_group_id) for every incoming message, sorted by time."""
+    rng = random.Random(seed)
+    events = []
+    for sender_id in range(1, senders + 1):
+        at = rng.expovariate(rate / 60)
+        while at < duration:
+            if rng.random() < album_share:
+                group_id = f"{sender_id}-{at:.3f}"
+                events.extend((at + part * 0.05, sender_id, group_id) for part in range(rng.randint(2, 10)))
+            else:
+                events.append((at, sender_id, None))
+            at += rng.expovariate(rate / 60)
+    return sorted(events)
+
+
+class Run:
+    def __init__(self, scale: float, relay_ms: float):
+        self.scale = scale
+        self.relay_s = relay_ms / 1000 * scale
+        self.latencies = []
+        self.wakeups = 0
+        self.idle_wakeups = 0
+
+    async def relay(self, sender_id, messages):
+        await asyncio.sleep(self.relay_s)
+        now = time.monotonic()
+        self.latencies.extend((now - msg.ingested) / self.scale for msg in messages)
+
+    async def feed(self, events, add):
+        started = time.monotonic()
+        for at, sender_id, group_id in events:
+            delay = started + at * self.scale - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            add(SimpleNamespace(chat_id=sender_id, media_group_id=group_id, ingested=time.monotonic()))
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "delivered": len(latencies),
+            "latency_p50_s": round(latencies[len(latencies) // 2], 3) if latencies else None,
+            "latency_p99_s": round(latencies[int(len(latencies) * 0.99)], 3) if latencies else None,
+            "latency_max_s": round(latencies[-1], 3) if latencies else None,
+            "wakeups": self.wakeups,
+            "idle_wakeups": self.idle_wakeups,
+            "elapsed_s": round(elapsed / self.scale, 1),
+        }
+
+
+async def run_poll(events, scale: float, relay_ms: float) -> dict:
+    """The old model: album parts are assembled, then everything waits for the next poll plus one second."""
+    run = Run(scale, relay_ms)
+    buffer = defaultdict(list)
+    groups = MediaGroupAssembler(lambda sender_id, messages: buffer[sender_id].extend(messages),
+                                 idle=media_groups.MEDIA_GROUP_IDLE * scale, deadline=media_groups.MEDIA_GROUP_DEADLINE * scale)
+    tasks = []
+
+    async def delayed_relay(sender_id, messages):
+        await asyncio.sleep(POLL_RUN_ONCE_DELAY * scale)
+        await run.relay(sender_id, messages)
+
+    async def poll():
+        while True:
+            await asyncio.sleep(POLL_INTERVAL * scale)
+            run.wakeups += 1
+            if not buffer:
+                run.idle_wakeups += 1
+                continue
+            batch = dict(buffer)
+            buffer.clear()
+            tasks.extend(asyncio.create_task(delayed_relay(sender_id, messages)) for sender_id, messages in batch.items())
+
+    def add(message):
+        if message.media_group_id:
+            groups.add(message)
+        else:
+            buffer[message.chat_id].append(message)
+
+    started = time.monotonic()
+    poller = asyncio.create_task(poll())
+    await run.feed(events, add)
+    while buffer or len(groups) or not all(task.done() for task in tasks):
+        await asyncio.sleep(0.01)
+    poller.cancel()
+    return run.report(time.monotonic() - started)
+
+
+async def run_event_driven(events, scale: float, relay_ms: float) -> dict:
+    run = Run(scale, relay_ms)
+    dispatcher = MediaDispatcher(run.relay, idle=media_dispatch.MEDIA_BUFFER_IDLE * scale,
+                                 max_wait=media_dispatch.MEDIA_BUFFER_MAX_WAIT * scale)
+    groups = MediaGroupAssembler(lambda sender_id, messages: dispatcher.add(sender_id, messages, complete=True),
+                                 idle=media_groups.MEDIA_GROUP_IDLE * scale, deadline=media_groups.MEDIA_GROUP_DEADLINE * scale)
+
+    def add(message):
+        if message.media_group_id:
+            groups.add(message)
+        else:
+            dispatcher.add(message.chat_id, [message])
+
+    started = time.monotonic()
+    await run.feed(events, add)
+    while len(dispatcher) or len(groups) or dispatcher.stats()['relays_running']:
+        await asyncio.sleep(0.01)
+    run.wakeups = sum(dispatcher.flushes.values())
+    report = run.report(time.monotonic() - started)
+    report["flushes"] = dict(dispatcher.flushes)
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=300, help="simulated seconds of incoming media")
+    parser.add_argument("--rate", type=float, default=2, help="posts per sender per minute")
+    parser.add_argument("--album-share", type=float, default=0.3)
+    parser.add_argument("--relay-ms", type=float, default=150, help="simulated time from relay start to first copy")
+    parser.add_argument("--scale", type=float, default=0.05, help="real seconds per simulated second")
+    args = parser.parse_args()
+
+    events = workload(args.senders, args.duration, args.rate, args.album_share)
+    report = {
+        "messages": len(events),
+        "poll": await run_poll(events, args.scale, args.relay_ms),
+        "event_driven": await run_event_driven(events, args.scale, args.relay_ms),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark for the render stage: rebuilding album payloads and the
+"From:" text for every recipient versus rendering them once per fan-out.
+
+    python -m benchmarks.bench_render [recipients]
+"""
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, PhotoSize, User
+
+from bot.utils.render import render_albums, render_text
+
+SENDER = User(id=1, first_name="Bench", is_bot=False)
+CHAT = Chat(id=1, type=Chat.PRIVATE)
+NOW = datetime.now(timezone.utc)
+
+
+def _photo_message(message_id: int) -> Message:
+    photo = [PhotoSize(file_id=f"photo-{message_id}-{size}", file_unique_id=f"u{message_id}{size}", width=size, height=size)
+             for size in (90, 320, 1280)]
+    return Message(message_id=message_id, date=NOW, chat=CHAT, from_user=SENDER, photo=photo,
+                   caption="An <album> caption" if message_id == 1 else None)
+
+
+def _per_recipient(messages, text_message, recipients):
+    for _ in range(recipients):
+        render_albums(messages)
+        f"<b>From: {SENDER.full_name}</b>\n\n{text_message.text_html}"
+
+
+def _once(messages, text_message, recipients):
+    albums = render_albums(messages)
+    payload = render_text(text_message, SENDER.full_name)
+    for _ in range(recipients):
+        for album in albums:
+            album.input_media
+        payload.html
+
+
+def _measure(fn, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    messages = [_photo_message(i) for i in range(1, 21)]
+    text_message = Message(message_id=100, date=NOW, chat=CHAT, from_user=SENDER, text="hello <world>")
+
+    for name, fn in (("per-recipient", _per_recipient), ("render-once", _once)):
+        elapsed, peak = _measure(fn, messages, text_message, recipients)
+        print(f"{name:>14}: {elapsed * 1000:9.1f} ms total, {elapsed / recipients * 1e6:7.2f} us/recipient, "
+              f"peak alloc {peak / 1024:8.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
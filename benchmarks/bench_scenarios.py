@@ -0,0 +1,315 @@
+"""
+Runs the whole bot offline: create_bot_application against the local fake
+Bot API server, with the in-process MongoDB stand-in from
+benchmarks.fake_mongo (needs mongomock). Scripted scenarios feed updates
+through the real handlers and report throughput, latency percentiles, Bot
+API calls and database operations as JSON, for regression tracking.
+
+    python -m benchmarks.bench_scenarios --recipients 1000 --senders 10 --output bench.json
+
+Scenarios (--scenarios, default all, in this order):
+  text    every sender posts --texts text messages at once
+  album   every sender posts --albums albums of 10 photos
+  pin     an admin pins a message for everyone
+  delete  an admin deletes a relayed message everywhere
+  sweep   the inactivity check demotes --inactive-share of the recipients
+
+Relay latency is measured from feeding an update to each copy being logged
+as relayed. For the others it is measured from the start of the scenario to
+each completed pin, delete or notice request. Telegram's rate limits are
+lifted unless RELAY_GLOBAL_RATE / RELAY_PER_CHAT_RATE / RELAY_PER_CHAT_BURST
+are set, so the numbers show the bot's own overhead. Fault injection
+(--latency-ms, --retry-after-rate, --forbidden-rate) happens in the fake
+server.
+"""
+import os
+
+# Read by the rate limiter at import time, so they must be set before the bot is imported.
+for _name in ("RELAY_GLOBAL_RATE", "RELAY_PER_CHAT_RATE", "RELAY_PER_CHAT_BURST"):
+    os.environ.setdefault(_name, "1000000")
+
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import subprocess
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from telegram import Update
+
+from benchmarks.fake_bot_api import CLIENT_MESSAGE_ID_BASE
+from benchmarks.fake_mongo import FakeMotorClient
+from bot import core
+from bot.jobs import scheduled_jobs
+from bot.utils import broadcast, db, metrics
+from bot.utils.media_handler import media_dispatcher, media_groups
+
+TOKEN = "123:fake"
+ADMIN_ID = 1
+FIRST_RECIPIENT = 100
+FIRST_SENDER = 10_000_000
+SCENARIOS = ("text", "album", "pin", "delete", "sweep")
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 4)
+
+
+def latency_report(latencies, prefix: str) -> dict:
+    return {f"{prefix}_p50_s": percentile(latencies, 0.5), f"{prefix}_p99_s": percentile(latencies, 0.99),
+            f"{prefix}_max_s": percentile(latencies, 1.0)}
+
+
+def counter_diff(after: dict, before: dict) -> dict:
+    return {key: after[key] - before.get(key, 0) for key in sorted(after) if after[key] != before.get(key, 0)}
+
+
+class Harness:
+    """Feeds updates to the application and records when their copies are delivered."""
+
+    def __init__(self, application, api_url: str):
+        self.application = application
+        self.api_url = api_url
+        self.ingested = {}
+        self.deliveries = defaultdict(list)
+        self.requests = []
+        self._update_id = 0
+        self._message_ids = Counter()
+
+        log_relayed_message = db.log_relayed_message
+
+        async def record_delivery(original_msg_id, sender_id, relayed_to, group_id=None):
+            now = time.monotonic()
+            self.deliveries[(sender_id, original_msg_id)].extend(now for _ in relayed_to)
+            return await log_relayed_message(original_msg_id, sender_id, relayed_to, group_id)
+        db.log_relayed_message = record_delivery
+
+        limiter = application.bot.rate_limiter
+        process_request = limiter.process_request
+
+        async def record_request(callback, args, kwargs, endpoint, data, rate_limit_args):
+            result = await process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+            self.requests.append((endpoint, time.monotonic()))
+            return result
+        limiter.process_request = record_request
+
+    def message(self, user_id: int, **fields) -> dict:
+        """An incoming message. Its ID is above every ID the fake server gives the bot's messages in that chat."""
+        self._message_ids[user_id] += 1
+        return {
+            'message_id': CLIENT_MESSAGE_ID_BASE + self._message_ids[user_id], 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}, **fields,
+        }
+
+    def command(self, user_id: int, command: str, reply_to: dict = None) -> dict:
+        fields = {'text': f"/{command}", 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}]}
+        if reply_to:
+            fields['reply_to_message'] = reply_to
+        return self.message(user_id, **fields)
+
+    async def feed(self, messages):
+        """Hands the messages to the application's update processor at once, as if they all arrived together."""
+        application = self.application
+        updates = []
+        for message in messages:
+            self._update_id += 1
+            updates.append(Update.de_json({'update_id': self._update_id, 'message': message}, application.bot))
+            self.ingested[(message['from']['id'], message['message_id'])] = time.monotonic()
+        await asyncio.gather(*(application.update_processor.process_update(update, application.process_update(update))
+                               for update in updates))
+
+    async def api_stats(self) -> dict:
+        def fetch():
+            with urllib.request.urlopen(f"{self.api_url}/stats") as response:
+                return json.loads(response.read())
+        return await asyncio.to_thread(fetch)
+
+    async def measure(self, run, endpoints=()) -> dict:
+        """Runs one scenario and reports what it cost."""
+        api_before = await self.api_stats()
+        db_before = dict(FakeMotorClient.operations)
+        calls_before = {labels[0]: count for labels, (count, _) in metrics.DB_LATENCY.totals().items()}
+        self.ingested.clear()
+        self.deliveries.clear()
+        self.requests.clear()
+
+        started = time.monotonic()
+        details = await run() or {}
+        elapsed = time.monotonic() - started
+
+        api_after = await self.api_stats()
+        calls_after = {labels[0]: count for labels, (count, _) in metrics.DB_LATENCY.totals().items()}
+        report = {"elapsed_s": round(elapsed, 3), **details}
+        if self.deliveries:
+            copies = [delivered - self.ingested[key] for key, times in self.deliveries.items()
+                      if key in self.ingested for delivered in times]
+            first = [min(times) - self.ingested[key] for key, times in self.deliveries.items() if key in self.ingested]
+            report.update(deliveries=len(copies), deliveries_per_s=round(len(copies) / elapsed, 1),
+                          **latency_report(copies, "delivery"), **latency_report(first, "first_delivery"))
+        if endpoints:
+            done = [at - started for endpoint, at in self.requests if endpoint in endpoints]
+            report.update(requests=len(done), requests_per_s=round(len(done) / elapsed, 1),
+                          **latency_report(done, "request"))
+        report.update(
+            api_calls=counter_diff(api_after["calls"], api_before["calls"]),
+            api_errors=counter_diff(api_after["errors"], api_before["errors"]),
+            db_operations=counter_diff(dict(FakeMotorClient.operations), db_before),
+            db_calls=counter_diff(calls_after, calls_before),
+        )
+        return report
+
+
+async def seed(recipients: int, senders: int, inactive_share: float):
+    now = datetime.utcnow()
+    long_ago = now - timedelta(days=30)
+    inactive = int(recipients * inactive_share)
+    users = []
+    for index, user_id in enumerate(range(FIRST_RECIPIENT, FIRST_RECIPIENT + recipients)):
+        last_active = long_ago if index < inactive else now
+        users.append({'user_id': user_id, 'full_name': f"User {user_id}", 'username': f"user{user_id}",
+                      'status': 'active', 'is_admin': False, 'is_whitelisted': False, 'join_date': long_ago,
+                      'last_active': last_active, 'media_sent_count': 0, 'total_messages_sent': 0})
+    for user_id in range(FIRST_SENDER, FIRST_SENDER + senders):
+        users.append({'user_id': user_id, 'full_name': f"Sender {user_id}", 'username': f"sender{user_id}",
+                      'status': 'active', 'is_admin': False, 'is_whitelisted': True, 'join_date': long_ago,
+                      'last_active': now, 'media_sent_count': 0, 'total_messages_sent': 0})
+    await db.db.users.insert_many(users)
+    await db.active_roster.load(db.db.users)
+
+
+async def wait_for_media_relays():
+    while len(media_groups) or len(media_dispatcher) or media_dispatcher.stats()['relays_running']:
+        await asyncio.sleep(0.05)
+
+
+def scenario_text(harness: Harness, senders, texts: int):
+    async def run():
+        await harness.feed([harness.message(sender, text=f"Benchmark text {n} from {sender}")
+                            for n in range(texts) for sender in senders])
+    return run
+
+
+def scenario_album(harness: Harness, senders, albums: int):
+    async def run():
+        messages = []
+        for sender in senders:
+            for album in range(albums):
+                messages.extend(harness.message(
+                    sender, media_group_id=f"{sender}-{album}",
+                    photo=[{'file_id': f"photo-{sender}-{album}-{item}", 'file_unique_id': f"u{sender}{album}{item}",
+                            'width': 1280, 'height': 960}],
+                    **({'caption': "Benchmark album"} if item == 0 else {})
+                ) for item in range(10))
+        await harness.feed(messages)
+        await wait_for_media_relays()
+    return run
+
+
+def scenario_pin(harness: Harness):
+    async def run():
+        await harness.feed([harness.command(ADMIN_ID, "pin", reply_to=harness.message(ADMIN_ID, text="Pinned"))])
+        while broadcast.running():
+            await asyncio.sleep(0.05)
+    return run
+
+
+async def prepare_delete(harness: Harness, sender: int) -> dict:
+    """Relays one message and returns the admin's copy of it to reply to."""
+    message = harness.message(sender, text="To be deleted")
+    await harness.feed([message])
+    relayed_to = (await db.get_relayed_message_info_by_original_id(message['message_id'], sender))['relayed_to']
+    copy_id = relayed_to.get(ADMIN_ID) or relayed_to.get(str(ADMIN_ID))
+    return {'message_id': copy_id, 'date': int(time.time()), 'chat': {'id': ADMIN_ID, 'type': 'private'},
+            'from': {'id': 0, 'is_bot': True, 'first_name': "Fake"}}
+
+
+def scenario_delete(harness: Harness, target: dict):
+    async def run():
+        await harness.feed([harness.command(ADMIN_ID, "delete", reply_to=target)])
+    return run
+
+
+def scenario_sweep(harness: Harness):
+    async def run():
+        await scheduled_jobs.check_inactive_users(SimpleNamespace(bot=harness.application.bot))
+        return {"active_after": len(db.active_roster)}
+    return run
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--texts", type=int, default=5, help="text messages per sender")
+    parser.add_argument("--albums", type=int, default=1, help="10-photo albums per sender")
+    parser.add_argument("--inactive-share", type=float, default=0.2)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--retry-after-rate", type=float, default=0)
+    parser.add_argument("--forbidden-rate", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="fake server processes (their stats are per process)")
+    parser.add_argument("--port", type=int, default=8094)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    server = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.fake_bot_api", "--port", str(args.port), "--token", TOKEN,
+        "--latency-ms", str(args.latency_ms), "--retry-after-rate", str(args.retry_after_rate),
+        "--forbidden-rate", str(args.forbidden_rate), "--workers", str(args.workers),
+    ])
+    api_url = f"http://127.0.0.1:{args.port}"
+    report = {"config": {key: value for key, value in vars(args).items() if key not in ("output", "verbose")},
+              "scenarios": {}}
+    db.AsyncIOMotorClient = FakeMotorClient
+    application = None
+    try:
+        await asyncio.sleep(1.5)
+        await db.init_database("mongodb://in-process", "bench_scenarios", str(ADMIN_ID))
+        await seed(args.recipients, args.senders, args.inactive_share)
+        application = core.create_bot_application(TOKEN, base_url=f"{api_url}/bot")
+        await application.initialize()
+        harness = Harness(application, api_url)
+        senders = list(range(FIRST_SENDER, FIRST_SENDER + args.senders))
+
+        for name in scenarios:
+            if name == "text":
+                run, endpoints = scenario_text(harness, senders, args.texts), ()
+            elif name == "album":
+                run, endpoints = scenario_album(harness, senders, args.albums), ()
+            elif name == "pin":
+                run, endpoints = scenario_pin(harness), ("pinChatMessage",)
+            elif name == "delete":
+                run, endpoints = scenario_delete(harness, await prepare_delete(harness, senders[0])), ("deleteMessages",)
+            else:
+                run, endpoints = scenario_sweep(harness), ("sendMessage",)
+            report["scenarios"][name] = await harness.measure(run, endpoints)
+    finally:
+        if application:
+            await application.shutdown()
+        await db.close_database()
+        server.terminate()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""
+Compares fan-out throughput of the single-process path with the sharded
+multi-process path against a local fake Bot API server.
+
+    python -m benchmarks.bench_sharding --recipients 5000 --shards 4
+
+Rate limits are lifted (RELAY_GLOBAL_RATE is set very high) so the numbers
+show the CPU-bound ceiling of each path, not Telegram's 30 msg/s cap. The gain
+depends on free cores: on a single-core host both paths perform the same.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+from telegram.constants import ParseMode
+from telegram.ext import Defaults, ExtBot
+
+from bot.utils.delivery import fan_out
+from bot.utils.rate_limiter import RelayRateLimiter
+from bot.utils.render import AlbumPayload, MediaItem
+from bot.utils.sharding import ShardPool
+
+TOKEN = "123:fake"
+UNLIMITED = 1_000_000
+
+
+def _album_payload() -> dict:
+    items = tuple(MediaItem('photo', f"photo-{i}", i) for i in range(1, 11))
+    return {'albums': [AlbumPayload.build(items, "Benchmark <b>album</b>", None).to_dict()]}
+
+
+async def _single(base_url: str, payload: dict, recipients: list) -> dict:
+    bot = ExtBot(TOKEN, base_url=base_url, defaults=Defaults(parse_mode=ParseMode.HTML),
+                 rate_limiter=RelayRateLimiter(global_rate=UNLIMITED, per_chat_burst=UNLIMITED))
+    await bot.initialize()
+    album = AlbumPayload.from_dict(payload['albums'][0])
+    result = await fan_out(recipients, lambda chat_id: album.send(bot, chat_id), label="bench single", demote_forbidden=False)
+    await bot.shutdown()
+    return {"sent": result.sent, "elapsed_s": round(result.elapsed, 3), "per_s": round(result.rate, 1)}
+
+
+async def _deliver(pool: ShardPool, payload: dict, recipients: list) -> list:
+    """Runs one sharded delivery and returns the summary of each shard."""
+    summaries = []
+    async for shard, event, data in pool.deliver('album', 0, payload, recipients, [{}], {}):
+        if event == 'result':
+            summaries.append(data[0])
+        elif event == 'error':
+            raise RuntimeError(f"Shard {shard} failed: {data[0]}")
+    return summaries
+
+
+async def _sharded(base_url: str, payload: dict, recipients: list, shards: int) -> dict:
+    pool = ShardPool(shards, TOKEN, base_url, global_rate=UNLIMITED)
+    pool.start()
+    # Warm up: let every shard start its interpreter and initialize its bot.
+    await _deliver(pool, payload, list(range(shards)))
+    started = time.monotonic()
+    results = await _deliver(pool, payload, recipients)
+    elapsed = time.monotonic() - started
+    await pool.stop()
+    sent = sum(r['sent'] for r in results)
+    return {"sent": sent, "elapsed_s": round(elapsed, 3), "per_s": round(sent / elapsed, 1)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=5000)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--server-workers", type=int, default=2)
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_bot_api", "--port", str(args.port),
+                               "--token", TOKEN, "--latency-ms", str(args.latency_ms),
+                               "--workers", str(args.server_workers)])
+    try:
+        await asyncio.sleep(1.5)
+        base_url = f"http://127.0.0.1:{args.port}/bot"
+        payload = _album_payload()
+        recipients = list(range(1000, 1000 + args.recipients))
+        single = await _single(base_url, payload, recipients)
+        sharded = await _sharded(base_url, payload, recipients, args.shards)
+        print(json.dumps({
+            "recipients": args.recipients, "shards": args.shards, "single_process": single, "sharded": sharded,
+            "speedup": round(sharded["per_s"] / single["per_s"], 2) if single["per_s"] else None,
+        }, indent=2))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+"""
+A local stand-in for the Telegram Bot API, for benchmarks.
+
+    python -m benchmarks.fake_bot_api --port 8081 --latency-ms 50
+
+Point a bot at it with base_url="http://127.0.0.1:8081/bot". Every request
+is answered after the configured latency. RetryAfter and Forbidden errors
+can be injected at a given rate. With --workers N several server processes
+share the port, so the fake server is not the bottleneck on multi-core hosts.
+Per-process counters are then reported separately by each worker.
+
+Message IDs are counted per chat, as Telegram does, and the workers number
+theirs so they never collide. They stay below CLIENT_MESSAGE_ID_BASE:
+clients simulating incoming messages number theirs from there, so a user's
+own messages and the bot's copies in that chat never share an ID.
+"""
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import multiprocessing
+from collections import Counter
+from urllib.parse import parse_qs
+
+from bot.web import Request, Response, WebServer
+
+METHODS = (
+    "getMe", "getUpdates", "setWebhook", "deleteWebhook", "sendMessage", "copyMessage", "sendMediaGroup",
+    "pinChatMessage", "deleteMessage", "deleteMessages", "answerCallbackQuery", "editMessageText", "sendDocument",
+)
+CLIENT_MESSAGE_ID_BASE = 1_000_000_000
+
+
+class FakeBotApi:
+    def __init__(self, token: str, latency: float = 0.0, retry_after_rate: float = 0.0, retry_after: int = 1,
+                 forbidden_rate: float = 0.0, seed: int = 0, worker: int = 0, workers: int = 1):
+        self.token = token
+        self.worker = worker
+        self.workers = workers
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.forbidden_rate = forbidden_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._message_ids = Counter()
+        self._forbidden = {}
+
+    def install(self, server: WebServer):
+        for method in METHODS:
+            server.route("POST", f"/bot{self.token}/{method}", self._handler(method))
+        server.route("GET", "/stats", self._stats)
+
+    async def _stats(self, request: Request) -> Response:
+        body = json.dumps({"calls": dict(self.calls), "errors": dict(self.errors)}).encode()
+        return Response(200, body, "application/json")
+
+    def _handler(self, method: str):
+        async def handle(request: Request) -> Response:
+            self.calls[method] += 1
+            params = self._parse(request)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            chat_id = params.get("chat_id")
+            if chat_id is not None and method not in ("getMe", "getUpdates"):
+                if self._is_forbidden(chat_id):
+                    self.errors["forbidden"] += 1
+                    return self._error(403, "Forbidden: bot was blocked by the user")
+                if self.retry_after_rate and self._random.random() < self.retry_after_rate:
+                    self.errors["retry_after"] += 1
+                    return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                       {"retry_after": self.retry_after})
+            return self._ok(self._result(method, params))
+        return handle
+
+    def _is_forbidden(self, chat_id) -> bool:
+        if not self.forbidden_rate:
+            return False
+        if chat_id not in self._forbidden:
+            self._forbidden[chat_id] = self._random.random() < self.forbidden_rate
+        return self._forbidden[chat_id]
+
+    @staticmethod
+    def _parse(request: Request) -> dict:
+        content_type = request.headers.get("content-type", "")
+        if "application/json" in content_type:
+            return json.loads(request.body or b"{}")
+        params = {}
+        for key, values in parse_qs(request.body.decode(), keep_blank_values=True).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def _message(self, chat_id) -> dict:
+        self._message_ids[chat_id] += 1
+        message_id = (self._message_ids[chat_id] - 1) * self.workers + self.worker + 1
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}}
+
+    def _result(self, method: str, params: dict):
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return self._message(chat_id)
+        if method == "copyMessage":
+            return {"message_id": self._message(chat_id)["message_id"]}
+        if method == "sendMediaGroup":
+            return [self._message(chat_id) for _ in params.get("media", [])]
+        return True
+
+    @staticmethod
+    def _ok(result) -> Response:
+        return Response(200, json.dumps({"ok": True, "result": result}).encode(), "application/json")
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: dict = None) -> Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return Response(code, json.dumps(body).encode(), "application/json")
+
+
+async def serve(port: int, api: FakeBotApi, reuse_port: bool = False):
+    server = WebServer(host="127.0.0.1", port=port, reuse_port=reuse_port)
+    api.install(server)
+    await server.start()
+    await asyncio.Event().wait()
+
+
+def _serve_process(port: int, api_kwargs: dict):
+    asyncio.run(serve(port, FakeBotApi(**api_kwargs), reuse_port=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="123:fake")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--retry-after-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--forbidden-rate", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="server processes sharing the port (SO_REUSEPORT)")
+    args = parser.parse_args()
+    api_kwargs = dict(token=args.token, latency=args.latency_ms / 1000, retry_after_rate=args.retry_after_rate,
+                      retry_after=args.retry_after, forbidden_rate=args.forbidden_rate)
+    if args.workers > 1:
+        processes = [multiprocessing.Process(target=_serve_process, daemon=True,
+                                             args=(args.port, {**api_kwargs, 'worker': i, 'workers': args.workers}))
+                     for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        # Daemon children are only cleaned up on a normal exit, not on SIGTERM, and would keep the port.
+        signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+        for process in processes:
+            process.join()
+    else:
+        asyncio.run(serve(args.port, FakeBotApi(**api_kwargs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+An in-process stand-in for MongoDB, for benchmarks that should run without
+a database server. It exposes the subset of Motor's asyncio API the bot uses
+on top of mongomock (pip install mongomock), and counts every operation
+per collection.
+
+    from benchmarks.fake_mongo import FakeMotorClient
+    db.AsyncIOMotorClient = FakeMotorClient
+
+Query semantics are mongomock's. Timings say nothing about a real server:
+use it to count operations and to measure the bot's own overhead.
+"""
+import copy
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+try:
+    import mongomock
+except ImportError:
+    raise SystemExit("benchmarks.fake_mongo needs mongomock: pip install mongomock")
+
+# Server-side commands the bot issues that mongomock does not implement.
+IGNORED_COMMANDS = {"collMod", "ping"}
+
+
+class FakeCursor:
+    def __init__(self, make_cursor, sort=None, limit: int = 0, skip: int = 0):
+        self._make_cursor = make_cursor
+        self._sort = sort
+        self._limit = limit
+        self._skip = skip
+        self._docs: Optional[list] = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = key_or_list if direction is None else [(key_or_list, direction)]
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def _load(self) -> list:
+        if self._docs is None:
+            cursor = self._make_cursor()
+            if self._sort:
+                cursor = cursor.sort(self._sort)
+            if self._skip:
+                cursor = cursor.skip(self._skip)
+            if self._limit:
+                cursor = cursor.limit(self._limit)
+            self._docs = list(cursor)
+        return self._docs
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        docs = self._load()
+        return docs[:length] if length else list(docs)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._load():
+            yield doc
+            await asyncio.sleep(0)
+
+
+def _simple_matcher(query: dict) -> Optional[Callable[[dict], bool]]:
+    """
+    A fast test for filters made only of top-level equalities and $in lists
+    of plain values, or None for anything else (left to mongomock).
+    """
+    tests = []
+    for key, value in query.items():
+        if key.startswith('$') or '.' in key or isinstance(value, list):
+            return None
+        if isinstance(value, dict):
+            if set(value) != {'$in'} or any(isinstance(v, (dict, list)) for v in value['$in']):
+                return None
+            tests.append((key, set(value['$in'])))
+        else:
+            tests.append((key, {value}))
+    return lambda doc: all(doc.get(key) in values for key, values in tests)
+
+
+class FakeCollection:
+    def __init__(self, database: "FakeDatabase", name: str):
+        self.database = database
+        self.name = name
+        self._collection = database._database[name]
+
+    def _count(self, operation: str):
+        self.database.client.operations[f"{self.name}.{operation}"] += 1
+
+    def find(self, *args, **kwargs) -> FakeCursor:
+        self._count("find")
+        return FakeCursor(lambda: self._collection.find(*args, **kwargs))
+
+    def aggregate(self, pipeline, **kwargs) -> FakeCursor:
+        self._count("aggregate")
+        return FakeCursor(lambda: self._collection.aggregate(pipeline, **kwargs))
+
+    @staticmethod
+    def _plain_upserts(requests) -> bool:
+        """Whether every request is an UpdateOne upsert that $sets fields on an equality match of the same keys."""
+        keys = tuple(requests[0]._filter) if requests and isinstance(requests[0], UpdateOne) else ()
+        return bool(keys) and all(
+            isinstance(op, UpdateOne) and op._upsert and tuple(op._filter) == keys and set(op._doc) == {'$set'}
+            and not any(isinstance(value, (dict, list)) for value in op._filter.values())
+            for op in requests
+        ) and not any('.' in key or key.startswith('$') for key in keys)
+
+    def _apply_plain_upserts(self, requests):
+        """
+        Applies the upserts in one pass over the collection. mongomock scans
+        every document for each operation, which makes relay log flushes
+        quadratic otherwise.
+        """
+        keys = tuple(requests[0]._filter)
+        store = self._collection._store
+        by_key = {tuple(doc.get(key) for key in keys): doc for doc in store.documents}
+        upserted = modified = 0
+        for op in requests:
+            match = tuple(op._filter[key] for key in keys)
+            doc = by_key.get(match)
+            if doc is None:
+                doc = by_key[match] = {'_id': ObjectId(), **op._filter}
+                store[doc['_id']] = doc
+                upserted += 1
+            else:
+                modified += 1
+            doc.update(copy.deepcopy(op._doc['$set']))
+        return upserted, modified
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        """Applied here: mongomock's own bulk_write does not accept current pymongo operations."""
+        self._count("bulk_write")
+        await asyncio.sleep(0)
+        requests = list(requests)
+        upserted = modified = deleted = inserted = 0
+        if self._plain_upserts(requests):
+            upserted, modified = self._apply_plain_upserts(requests)
+            requests = []
+        for op in requests:
+            if isinstance(op, (UpdateOne, UpdateMany)):
+                update = self._collection.update_one if isinstance(op, UpdateOne) else self._collection.update_many
+                result = update(op._filter, op._doc, upsert=op._upsert)
+                modified += result.modified_count
+                upserted += result.upserted_id is not None
+            elif isinstance(op, ReplaceOne):
+                result = self._collection.replace_one(op._filter, op._doc, upsert=op._upsert)
+                modified += result.modified_count
+                upserted += result.upserted_id is not None
+            elif isinstance(op, (DeleteOne, DeleteMany)):
+                delete = self._collection.delete_one if isinstance(op, DeleteOne) else self._collection.delete_many
+                deleted += delete(op._filter).deleted_count
+            elif isinstance(op, InsertOne):
+                self._collection.insert_one(op._doc)
+                inserted += 1
+            else:
+                raise TypeError(f"Unsupported bulk operation {type(op).__name__}")
+        return SimpleNamespace(inserted_count=inserted, modified_count=modified, deleted_count=deleted,
+                               upserted_count=upserted, acknowledged=True)
+
+    async def insert_many(self, documents, ordered: bool = True):
+        """Checks unique indexes in one pass: mongomock scans the collection for every inserted document."""
+        self._count("insert_many")
+        await asyncio.sleep(0)
+        store = self._collection._store
+        unique = [[field for field, _ in index['key']] for index in store.indexes.values()
+                  if index.get('unique') and not index.get('sparse') and 'partialFilterExpression' not in index]
+        seen = [{tuple(doc.get(field) for field in fields) for doc in store.documents} for fields in unique]
+        inserted_ids = []
+        for document in documents:
+            for fields, keys in zip(unique, seen):
+                key = tuple(document.get(field) for field in fields)
+                if key in keys:
+                    raise DuplicateKeyError(f"E11000 duplicate key error on {fields}: {key}", 11000)
+                keys.add(key)
+            document.setdefault('_id', ObjectId())
+            store[document['_id']] = copy.deepcopy(document)
+            inserted_ids.append(document['_id'])
+        return SimpleNamespace(inserted_ids=inserted_ids, acknowledged=True)
+
+    async def _update(self, operation: str, query: dict, update: dict, many: bool, **kwargs):
+        """$set updates on simple filters in one cheap pass; everything else goes to mongomock."""
+        self._count(operation)
+        await asyncio.sleep(0)
+        match = _simple_matcher(query)
+        if match is None or set(update) != {'$set'} or kwargs.get('upsert'):
+            method = self._collection.update_many if many else self._collection.update_one
+            return method(query, update, **kwargs)
+        matched = modified = 0
+        for doc in self._collection._store.documents:
+            if not match(doc):
+                continue
+            matched += 1
+            if any(doc.get(key, object()) != value for key, value in update['$set'].items()):
+                doc.update(copy.deepcopy(update['$set']))
+                modified += 1
+            if not many:
+                break
+        return SimpleNamespace(matched_count=matched, modified_count=modified, upserted_id=None, acknowledged=True)
+
+    async def update_one(self, query: dict, update: dict, **kwargs):
+        return await self._update("update_one", query, update, False, **kwargs)
+
+    async def update_many(self, query: dict, update: dict, **kwargs):
+        return await self._update("update_many", query, update, True, **kwargs)
+
+    def __getattr__(self, operation: str):
+        method = getattr(self._collection, operation)
+
+        async def call(*args, **kwargs):
+            self._count(operation)
+            await asyncio.sleep(0)
+            return method(*args, **kwargs)
+        return call
+
+
+class FakeDatabase:
+    def __init__(self, client: "FakeMotorClient", name: str):
+        self.client = client
+        self.name = name
+        self._database = client._client[name]
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, command, *args, **kwargs):
+        self.client.operations[f"command.{command}"] += 1
+        if command in IGNORED_COMMANDS:
+            return {"ok": 1}
+        return self._database.command(command, *args, **kwargs)
+
+
+class FakeMotorClient:
+    """Drop-in for AsyncIOMotorClient. All clients in a process share one set of databases."""
+
+    _client = None
+    operations: Counter = Counter()
+
+    def __init__(self, *args, **kwargs):
+        if FakeMotorClient._client is None:
+            FakeMotorClient._client = mongomock.MongoClient()
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        return FakeDatabase(self, name)
+
+    async def drop_database(self, name: str):
+        self._client.drop_database(name)
+
+    def close(self):
+        pass
@@ -5,17 +5,40 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
     Defaults,
 )
+from telegram import Update
 from telegram.constants import ParseMode
 
 from .handlers import user_handlers, admin_handlers, callback_handlers
 from .jobs import scheduled_jobs
 from .utils.media_handler import media_message_handler
+from .utils.rate_limiter import RelayRateLimiter
+from .utils.update_processor import ChatOrderedUpdateProcessor
+from .utils.metrics import count_update
+from .utils import tracing
 
-def create_bot_application(bot_token: str) -> Application:
-    """Builds the bot application and registers all handlers and jobs."""
+# Updates handled at once. A relay to every user no longer holds up approvals and commands behind it.
+# Each chat's updates are still handled one after another, in order.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+
+class TracingApplication(Application):
+    """Records a trace of every update, so slow ones can be broken down by stage."""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        with tracing.trace(tracing.update_name(update)):
+            await super().process_update(update)
+
+
+def create_bot_application(bot_token: str, base_url: str = None) -> Application:
+    """
+    Builds the bot application and registers all handlers and jobs.
+    `base_url` points the bot at another Bot API server, e.g. the benchmarks' fake one.
+    """
     
     # Use the Defaults class as required by the library
     # disable_web_page_preview is not a valid argument here.
@@ -24,16 +47,24 @@ def create_bot_application(bot_token: str) -> Application:
     )
 
     # Set disable_web_page_preview on the ApplicationBuilder itself
+    builder = ApplicationBuilder()
+    if base_url:
+        builder = builder.base_url(base_url)
     application = (
-        ApplicationBuilder()
+        builder
+        .application_class(TracingApplication)
         .token(bot_token)
         .defaults(defaults)
         .http_version("1.1")
         .get_updates_http_version("1.1")
+        .rate_limiter(RelayRateLimiter())
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
         .build()
     )
     
     # --- Register Handlers ---
+    # Group -1 runs before every other handler and only counts the update.
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
     application.add_handler(CommandHandler("start", user_handlers.start, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("admin", user_handlers.admin_contact, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("promote", admin_handlers.promote_admin, filters=filters.ChatType.PRIVATE))
@@ -44,7 +75,13 @@ def create_bot_application(bot_token: str) -> Application:
     application.add_handler(CommandHandler("unwhitelist", admin_handlers.unwhitelist_user, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("service_message", admin_handlers.set_service_message, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("pin", admin_handlers.pin_message_globally, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("broadcast_status", admin_handlers.broadcast_status, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("broadcast_cancel", admin_handlers.broadcast_cancel, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("userinfo", admin_handlers.user_info, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("dbstats", admin_handlers.db_stats, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("queue", admin_handlers.relay_queue, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("slow", admin_handlers.slow_updates, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("profile", admin_handlers.profile, filters=filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler(
         "delete",
         admin_handlers.delete_message,
@@ -58,10 +95,11 @@ def create_bot_application(bot_token: str) -> Application:
     
     # --- Schedule Background Jobs ---
     job_queue = application.job_queue
+    job_queue.run_once(scheduled_jobs.resume_deliveries_job, when=5)
     job_queue.run_repeating(scheduled_jobs.check_inactive_users, interval=3600, first=60)
     job_queue.run_repeating(scheduled_jobs.send_service_message, interval=3600 * 3, first=120)
     job_queue.run_repeating(scheduled_jobs.send_daily_summary, interval=3600 * 24, first=180)
     job_queue.run_repeating(scheduled_jobs.send_weekly_summary, interval=3600 * 24 * 7, first=300)
-    job_queue.run_repeating(scheduled_jobs.process_media_buffers_job, interval=15, first=15)
+    job_queue.run_repeating(scheduled_jobs.archive_relay_logs_job, interval=3600, first=600)
 
     return application
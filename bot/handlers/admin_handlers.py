@@ -1,14 +1,22 @@
+import io
 import logging
-import asyncio
-from telegram import Update
+from datetime import datetime
+from bson import ObjectId
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from telegram.error import BadRequest, Forbidden
 
-from ..utils import db
+from ..utils import db, broadcast
+from ..utils.delivery import fan_out
+from ..utils.scheduler import relay_scheduler
+from ..utils.rate_limiter import lane
+from ..utils import tracing
+from ..utils.profiling import PROFILE_MAX_SECONDS, loop_monitor, sample_profile
 from ..utils.decorators import admin_only
 from ..utils.helpers import get_user_id_from_command
 
 logger = logging.getLogger(__name__)
+# Telegram's deleteMessages accepts at most 100 message IDs per call.
+MAX_DELETE_BATCH = 100
 
 @admin_only
 async def promote_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,31 +122,39 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     replied_to_id = update.message.reply_to_message.message_id
     
-    # Check if the admin is deleting a message in their own chat that they sent
-    message_log = await db.get_relayed_message_info_by_original_id(replied_to_id)
-    
-    # If not found, check if they are replying to a relayed message from someone else
-    if not message_log:
-        message_log = await db.get_relayed_message_info_by_relayed_id(update.effective_chat.id, replied_to_id)
-
-    if not message_log:
+    # Works both for a relayed copy and for a message the admin sent themselves
+    origin = await db.get_message_origin(update.effective_chat.id, replied_to_id)
+    if not origin:
         await update.message.reply_text("Message not found in relay logs.")
         return
 
-    deleted_count, failed_count = 0, 0
-    # Also delete the sender's original message
-    all_to_delete = {**message_log.get('relayed_to', {}), message_log['sender_id']: message_log['original_message_id']}
+    # The whole album it was relayed in, including the sender's originals
+    sender_id, original_msg_id = origin
+    group = await db.get_message_group(original_msg_id, sender_id)
+    copies = group['copies']
+    status_message = await update.message.reply_text(
+        f"Deleting {len(group['original_message_ids'])} message(s) in {len(copies)} chats..."
+    )
+
+    async def delete_copies(chat_id: int):
+        message_ids = copies[chat_id]
+        for i in range(0, len(message_ids), MAX_DELETE_BATCH):
+            await context.bot.delete_messages(chat_id=chat_id, message_ids=message_ids[i:i + MAX_DELETE_BATCH])
+
+    async def report_progress(result):
+        await status_message.edit_text(f"Deleting... {result.sent + result.failed}/{result.recipients} chats done.")
 
-    for chat_id, message_id in all_to_delete.items():
-        try:
-            await context.bot.delete_message(chat_id=int(chat_id), message_id=message_id)
-            deleted_count += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            failed_count += 1
-            
-    await db.delete_relayed_message_log(message_log['original_message_id'])
-    await update.message.reply_text(f"Delete complete. Success: {deleted_count}, Failed: {failed_count}.")
+    with lane('text'):
+        result = await fan_out(
+            copies, delete_copies, label="global delete", demote_forbidden=False,
+            on_progress=report_progress, progress_interval=5
+        )
+
+    for message_id in group['original_message_ids']:
+        await db.delete_relayed_message_log(message_id, sender_id)
+    await status_message.edit_text(
+        f"Delete complete. Chats: {result.sent} succeeded, {result.failed} failed. Took {result.elapsed:.1f}s."
+    )
 
 @admin_only
 async def pin_message_globally(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -146,47 +162,98 @@ async def pin_message_globally(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Reply to a message to pin it.")
         return
     message_to_pin = update.message.reply_to_message
-    active_users = await db.get_all_active_users()
-    pinned_count, failed_count = 0, 0
-    await update.message.reply_text(f"Pinning message for {len(active_users)} users...")
-    for user in active_users:
-        try:
-            sent_msg = await context.bot.copy_message(
-                chat_id=user['user_id'], from_chat_id=message_to_pin.chat_id, message_id=message_to_pin.message_id
-            )
-            await context.bot.pin_chat_message(
-                chat_id=user['user_id'], message_id=sent_msg.message_id, disable_notification=True
-            )
-            pinned_count += 1
-            await asyncio.sleep(0.1)
-        except Forbidden:
-            failed_count += 1
-            await db.update_user_status(user['user_id'], 'inactive')
-        except Exception:
-            failed_count += 1
-    await update.message.reply_text(f"Pinning complete. Pinned: {pinned_count}, Failed: {failed_count}.")
+    job = await broadcast.start(
+        context.bot, 'pin', {'from_chat_id': message_to_pin.chat_id, 'message_id': message_to_pin.message_id},
+        created_by=update.effective_user.id
+    )
+    await update.message.reply_text(
+        f"Pinning message for {job.total} users in the background (broadcast <code>{job.id}</code>).\n"
+        f"Use /broadcast_status to follow it and /broadcast_cancel {job.id} to stop it."
+    )
 
 @admin_only
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_users = await db.get_all_users()
-    total = len(all_users)
-    active = sum(1 for u in all_users if u.get('status') == 'active')
-    banned = sum(1 for u in all_users if u.get('status') == 'banned')
-    sorted_users = sorted(all_users, key=lambda u: u.get('media_sent_count', 0), reverse=True)
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    broadcasts = await broadcast.recent()
+    if not broadcasts:
+        await update.message.reply_text("No broadcasts yet.")
+        return
+    text = "📣 <b>Recent Broadcasts</b>\n"
+    for job in broadcasts:
+        text += (
+            f"\n<code>{job.id}</code> {job.kind} - <b>{job.status}</b>\n"
+            f"   {job.done}/{job.total} users, Sent: {job.sent}, Failed: {job.failed}, "
+            f"Started: {job.created_at.strftime('%Y-%m-%d %H:%M') if job.created_at else 'N/A'} UTC\n"
+        )
+    await update.message.reply_text(text)
+
+@admin_only
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
+    if len(parts) < 2 or not ObjectId.is_valid(parts[1]):
+        await update.message.reply_text("Usage: `/broadcast_cancel <broadcast_id>` (see /broadcast_status).")
+        return
+    if await broadcast.cancel(ObjectId(parts[1])):
+        await update.message.reply_text(f"Broadcast <code>{parts[1]}</code> cancelled.")
+    else:
+        await update.message.reply_text("No running broadcast with that ID.")
+
+STATS_PAGE_SIZE = 20
+
+async def _render_stats_page(offset: int = 0, after: tuple = None, before: tuple = None):
+    totals = await db.get_user_totals()
+    users = await db.get_top_users(STATS_PAGE_SIZE, before=before) if before else []
+    has_next = True
+    if len(users) < STATS_PAGE_SIZE:
+        # A short previous page means we reached the top: show the first page instead.
+        if before:
+            offset, after = 0, None
+        users = await db.get_top_users(STATS_PAGE_SIZE + 1, after=after)
+        has_next = len(users) > STATS_PAGE_SIZE
+        users = users[:STATS_PAGE_SIZE]
+    by_status = totals['by_status']
     stats_msg = (
         f"📊 <b>Bot Statistics</b>\n"
-        f"Total: {total}, Active: {active}, Banned: {banned}\n\n"
-        "<b>Top 20 by Media Sent:</b>\n"
+        f"Total: {totals['total']}, Active: {by_status.get('active', 0)}, Banned: {by_status.get('banned', 0)}\n\n"
+        + (f"<b>Top by Media Sent ({offset + 1}-{offset + len(users)}):</b>\n" if users else "<b>Top by Media Sent:</b>\n")
     )
-    if not sorted_users:
+    if not users:
         stats_msg += "<i>No activity yet.</i>"
+    for i, user in enumerate(users, start=offset + 1):
+        stats_msg += (
+            f"<b>{i}.</b> {user.get('full_name')} (@{user.get('username')})\n"
+            f"   ID: <code>{user['user_id']}</code>, Media: {user.get('media_sent_count', 0)}\n"
+        )
+    buttons = []
+    if users and offset > 0:
+        first = users[0]
+        buttons.append(InlineKeyboardButton(
+            "◀️ Prev", callback_data=f"stats_prev_{max(offset - STATS_PAGE_SIZE, 0)}_{first.get('media_sent_count', 0)}_{first['user_id']}"
+        ))
+    if users and has_next:
+        last = users[-1]
+        buttons.append(InlineKeyboardButton(
+            "Next ▶️", callback_data=f"stats_next_{offset + len(users)}_{last.get('media_sent_count', 0)}_{last['user_id']}"
+        ))
+    return stats_msg, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@admin_only
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats_msg, reply_markup = await _render_stats_page()
+    await update.message.reply_text(stats_msg, reply_markup=reply_markup)
+
+async def stats_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles the /stats Prev/Next buttons: stats_<next|prev>_<offset>_<media_sent_count>_<user_id>."""
+    query = update.callback_query
+    if not await db.is_admin(query.from_user.id):
+        logger.warning(f"Unauthorized access denied for {query.from_user.id} to stats paging.")
+        return
+    _, direction, offset, media, user_id = query.data.split('_')
+    cursor = (int(media), int(user_id))
+    if direction == 'prev':
+        stats_msg, reply_markup = await _render_stats_page(int(offset), before=cursor)
     else:
-        for i, user in enumerate(sorted_users[:20]):
-            stats_msg += (
-                f"<b>{i+1}.</b> {user.get('full_name')} (@{user.get('username')})\n"
-                f"   ID: <code>{user['user_id']}</code>, Media: {user.get('media_sent_count', 0)}\n"
-            )
-    await update.message.reply_text(stats_msg)
+        stats_msg, reply_markup = await _render_stats_page(int(offset), after=cursor)
+    await query.edit_message_text(stats_msg, reply_markup=reply_markup)
 
 @admin_only
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -213,3 +280,79 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Last Active: {user_data.get('last_active', 'N/A').strftime('%Y-%m-%d %H:%M') if user_data.get('last_active') else 'N/A'} UTC"
     )
     await update.message.reply_text(info_text)
+
+def _format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+@admin_only
+async def db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = await db.get_storage_stats()
+    text = (
+        f"🗄 <b>Database Storage</b>\n"
+        f"Data: {_format_bytes(stats['data_size'])}, On disk: {_format_bytes(stats['storage_size'])}, "
+        f"Indexes: {_format_bytes(stats['index_size'])}\n"
+    )
+    for coll in stats['collections']:
+        text += (
+            f"\n<b>{coll['name']}</b>: {coll['count']} docs, data {_format_bytes(coll['size'])}, "
+            f"disk {_format_bytes(coll['storage_size'])}, indexes {_format_bytes(coll['index_size'])}\n"
+        )
+        for index_name, size in sorted(coll['indexes'].items(), key=lambda item: -item[1]):
+            text += f"   <code>{index_name}</code>: {_format_bytes(size)}\n"
+    await update.message.reply_text(text)
+
+@admin_only
+async def relay_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = relay_scheduler.stats()
+    text = (
+        f"📬 <b>Relay Queue</b>\n"
+        f"Slots in use: {stats['slots_in_use']}/{stats['slots']}, Queued sends: {stats['backlog']}\n"
+        f"Slot wait p50: {stats['wait_p50']:.2f}s, p99: {stats['wait_p99']:.2f}s\n"
+    )
+    flows = relay_scheduler.flows(limit=10)
+    if not flows:
+        text += "\n<i>Nothing queued.</i>"
+    for flow in flows:
+        text += (
+            f"\n<code>{flow['flow']}</code>: {flow['backlog']} queued, {flow['in_flight']} sending, "
+            f"avg wait {flow['avg_wait']:.2f}s, max {flow['max_wait']:.2f}s"
+        )
+    await update.message.reply_text(text)
+
+@admin_only
+async def slow_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    slow = list(tracing.SLOW_TRACES)[-10:]
+    text = (
+        f"🐢 <b>Slow Updates</b> (over {tracing.SLOW_UPDATE_SECONDS:g}s)\n"
+        f"Event loop: max lag {loop_monitor.max_lag:.3f}s, {loop_monitor.stalls} stalls\n"
+    )
+    if not slow:
+        text += "\n<i>None recorded.</i>"
+    for trace in reversed(slow):
+        text += (
+            f"\n<b>{datetime.fromtimestamp(trace.started_at):%H:%M:%S}</b> {trace.name}: {trace.duration:.2f}s"
+            f"{' (' + trace.error + ')' if trace.error else ''}\n   {trace.breakdown()}\n"
+        )
+    await update.message.reply_text(text, parse_mode=None)
+
+@admin_only
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        seconds = float(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text(f"Usage: /profile [seconds, at most {PROFILE_MAX_SECONDS}]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    await update.message.reply_text(f"⏱ Profiling the bot for {seconds:g}s...")
+    collapsed, samples, top = await sample_profile(seconds)
+    caption = f"{samples} samples over {seconds:g}s. Most seen:\n" + "\n".join(
+        f"{count * 100 // max(samples, 1)}% {frame}" for frame, count in top
+    )
+    await update.message.reply_document(
+        document=io.BytesIO(collapsed.encode()), filename=f"profile-{datetime.utcnow():%Y%m%d-%H%M%S}.txt",
+        caption=caption[:1024], parse_mode=None
+    )
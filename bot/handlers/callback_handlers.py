@@ -4,6 +4,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 from ..utils import db
+from . import admin_handlers
 
 logger = logging.getLogger(__name__)
 APPROVAL_CHANNEL_ID = os.getenv("APPROVAL_CHANNEL_ID", "-1002556330446")
@@ -21,6 +22,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_approval_request(update, context)
     elif action in ["approve", "deny"]: # approve_{user_id} or deny_{user_id}
         await handle_user_approval_decision(update, context)
+    elif action == "stats": # stats_{next|prev}_{offset}_{media_sent_count}_{user_id}
+        await admin_handlers.stats_page(update, context)
     else:
         logger.warning(f"Unhandled callback query action: {action}")
         await query.edit_message_text("This button seems to be outdated or invalid.")
@@ -1,65 +1,101 @@
 import os
+import time
 import logging
 from telegram.ext import ContextTypes
-from telegram.error import Forbidden
 
-from ..utils import db
-from ..utils.media_handler import dispatch_media_processing
+from ..utils import db, broadcast
+from ..utils.delivery import fan_out
+from ..utils.rate_limiter import lane
+from ..utils.metrics import scheduled_job
+from ..utils.media_handler import resume_pending_deliveries
 
 logger = logging.getLogger(__name__)
 INACTIVITY_DAYS = 7
+# Media a user must send within INACTIVITY_DAYS to stay active.
+INACTIVITY_MIN_MEDIA = 25
 
+@scheduled_job
 async def check_inactive_users(context: ContextTypes.DEFAULT_TYPE):
     APPROVAL_CHANNEL_ID = os.getenv("APPROVAL_CHANNEL_ID" , "-1002556330446")
-    inactive_users = await db.find_inactive_users(days=INACTIVITY_DAYS)
-    if not inactive_users: return
-    count = 0
-    for user in inactive_users:
-        await db.update_user_status(user['user_id'], 'inactive')
-        count += 1
-        try:
-            await context.bot.send_message(user['user_id'], "You have been marked as inactive.")
-        except Exception: pass
-    logger.info(f"Deactivated {count} inactive users.")
+    started = time.monotonic()
+    inactive_ids = [user['user_id'] for user in await db.find_inactive_users(days=INACTIVITY_DAYS, min_media=INACTIVITY_MIN_MEDIA)]
+    if not inactive_ids: return
+    count = await db.deactivate_users(inactive_ids)
+    logger.info(f"Deactivated {count} inactive users in {time.monotonic() - started:.1f}s. Sending notices.")
+
+    status_message = None
     if count > 0 and APPROVAL_CHANNEL_ID:
-        await context.bot.send_message(APPROVAL_CHANNEL_ID, f"🧹 Deactivated {count} users.")
+        status_message = await context.bot.send_message(APPROVAL_CHANNEL_ID, f"🧹 Deactivated {count} users. Notifying them...")
+
+    async def report_progress(result):
+        if status_message:
+            await status_message.edit_text(
+                f"🧹 Deactivated {count} users. Notified {result.sent}/{result.recipients} ({result.failed} failed)..."
+            )
 
+    with lane('bulk'):
+        result = await fan_out(
+            inactive_ids,
+            lambda chat_id: context.bot.send_message(chat_id, "You have been marked as inactive."),
+            label="inactivity notice", demote_forbidden=False, on_progress=report_progress
+        )
+    if status_message:
+        await status_message.edit_text(
+            f"🧹 Deactivated {count} users. Notified {result.sent}, failed {result.failed}. "
+            f"Took {time.monotonic() - started:.0f}s."
+        )
+
+@scheduled_job
 async def send_service_message(context: ContextTypes.DEFAULT_TYPE):
     service_message = await db.get_config_value('service_message')
     if not service_message: return
-    active_users = await db.get_all_active_users()
-    for user in active_users:
-        try:
-            await context.bot.send_message(chat_id=user['user_id'], text=service_message)
-        except Exception: pass
+    if broadcast.running('service'):
+        logger.warning("Previous service message broadcast is still running, skipping this one.")
+        return
+    await broadcast.start(context.bot, 'service', {'text': service_message})
 
-async def _send_summary(context: ContextTypes.DEFAULT_TYPE, period: str):
+async def _send_summary(context: ContextTypes.DEFAULT_TYPE, period: str, days: int):
     APPROVAL_CHANNEL_ID = os.getenv("APPROVAL_CHANNEL_ID" , "-1002556330446")
     if not APPROVAL_CHANNEL_ID:
         logger.warning(f"Cannot send {period} summary: APPROVAL_CHANNEL_ID not set.")
         return
 
-    all_users = await db.get_all_users()
-    total_msgs = sum(u.get('total_messages_sent', 0) for u in all_users)
-    sorted_users = sorted(all_users, key=lambda u: u.get('media_sent_count', 0), reverse=True)
+    summary = await db.get_activity_summary(days, top=10)
     
-    text = f"🗓️ <b>{period.title()} Summary</b>\nTotal Msgs: {total_msgs}\n\n<b>🏆 Top 10 by Media:</b>\n"
-    top_ten = [u for u in sorted_users[:10] if u.get('media_sent_count', 0) > 0]
-    if not top_ten:
+    text = (
+        f"🗓️ <b>{period.title()} Summary</b>\n"
+        f"Msgs: {summary['messages']}, Media: {summary['media']}, Active senders: {summary['active_users']}\n\n"
+        f"<b>🏆 Top 10 by Media:</b>\n"
+    )
+    if not summary['top']:
         text += "<i>No media activity.</i>"
     else:
-        for i, user in enumerate(top_ten):
-            text += f"<b>{i+1}.</b> {user.get('full_name')} - {user.get('media_sent_count')}\n"
+        for i, user in enumerate(summary['top']):
+            text += f"<b>{i+1}.</b> {user.get('full_name', user['user_id'])} - {user['media']}\n"
     await context.bot.send_message(chat_id=APPROVAL_CHANNEL_ID, text=text)
 
+@scheduled_job
 async def send_daily_summary(context: ContextTypes.DEFAULT_TYPE):
-    await _send_summary(context, 'daily')
+    await _send_summary(context, 'daily', days=1)
     
+@scheduled_job
 async def send_weekly_summary(context: ContextTypes.DEFAULT_TYPE):
-    await _send_summary(context, 'weekly')
+    await _send_summary(context, 'weekly', days=7)
     
-async def process_media_buffers_job(context: ContextTypes.DEFAULT_TYPE):
+@scheduled_job
+async def resume_deliveries_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs once after startup to pick up deliveries interrupted by a restart.
+    """
+    await resume_pending_deliveries(context)
+    resumed = await broadcast.resume_all(context.bot)
+    if resumed:
+        logger.info(f"Resumed {resumed} broadcasts.")
+
+@scheduled_job
+async def archive_relay_logs_job(context: ContextTypes.DEFAULT_TYPE):
     """
-    This is the entry point for the periodic job. It calls the dispatcher.
+    Exports and deletes relay logs past their retention period when an archive
+    directory is configured. Otherwise the TTL index expires them.
     """
-    await dispatch_media_processing(context)
+    await db.archive_relay_logs()
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+def hour_bucket(when: datetime) -> datetime:
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+class ActivityAggregator:
+    """
+    Coalesces per-user `last_active` timestamps and counter increments in
+    memory and writes them as one bulk_write per flush. Counter increments
+    are also added to hourly per-user buckets, so activity over any window
+    can be summed without reading lifetime totals.
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, dict] = {}
+        self._inflight: Dict[int, dict] = {}
+        self._buckets: Dict[Tuple[int, datetime], Dict[str, int]] = {}
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _entry(self, user_id: int) -> dict:
+        return self._pending.setdefault(user_id, {'last_active': None, 'inc': {}})
+
+    def touch(self, user_id: int, when: Optional[datetime] = None):
+        self._entry(user_id)['last_active'] = when or datetime.utcnow()
+
+    def increment(self, user_id: int, field: str, amount: int, when: Optional[datetime] = None):
+        inc = self._entry(user_id)['inc']
+        inc[field] = inc.get(field, 0) + amount
+        bucket = self._buckets.setdefault((user_id, hour_bucket(when or datetime.utcnow())), {})
+        bucket[field] = bucket.get(field, 0) + amount
+
+    def overlay(self, user: Optional[dict]) -> Optional[dict]:
+        """Applies not-yet-written activity to a user document read from MongoDB."""
+        if not user:
+            return user
+        entries = [e for e in (self._inflight.get(user['user_id']), self._pending.get(user['user_id'])) if e]
+        if not entries:
+            return user
+        user = dict(user)
+        for entry in entries:
+            if entry['last_active'] and (not user.get('last_active') or entry['last_active'] > user['last_active']):
+                user['last_active'] = entry['last_active']
+            for field, amount in entry['inc'].items():
+                user[field] = user.get(field, 0) + amount
+        return user
+
+    async def flush(self, collection, buckets_collection=None):
+        async with self._flush_lock:
+            try:
+                await self._flush_users(collection)
+            finally:
+                if buckets_collection is not None:
+                    await self._flush_buckets(buckets_collection)
+
+    async def _flush_users(self, collection):
+        if not self._pending:
+            return
+        pending = self._inflight = self._pending
+        self._pending = {}
+        entries = list(pending.items())
+        ops = []
+        for user_id, entry in entries:
+            update = {}
+            if entry['last_active']:
+                update['$max'] = {'last_active': entry['last_active']}
+            if entry['inc']:
+                update['$inc'] = entry['inc']
+            ops.append(UpdateOne({'user_id': user_id}, update))
+        try:
+            await collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every op not listed in writeErrors was applied, so only
+            # the failed ones are re-queued; re-adding the rest would double-count.
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+            logger.error(f"Activity flush failed for {len(failed)} of {len(ops)} users, will retry them: {e}")
+            for index in sorted(failed):
+                self._requeue_user(*entries[index])
+            raise
+        except Exception as e:
+            # Unknown how many ops were applied. `$max` is safe to repeat, `$inc` is not.
+            lost = sum(1 for _, entry in entries if entry['inc'])
+            logger.error(f"Activity flush of {len(ops)} users failed, counter increments of {lost} users dropped: {e}")
+            for user_id, entry in entries:
+                if entry['last_active']:
+                    self._requeue_user(user_id, {'last_active': entry['last_active'], 'inc': {}})
+            raise
+        finally:
+            self._inflight = {}
+
+    def _requeue_user(self, user_id: int, entry: dict):
+        if entry['last_active']:
+            self.touch(user_id, max(entry['last_active'], self._entry(user_id)['last_active'] or entry['last_active']))
+        retry = self._entry(user_id)['inc']
+        for field, amount in entry['inc'].items():
+            retry[field] = retry.get(field, 0) + amount
+
+    async def _flush_buckets(self, collection):
+        if not self._buckets:
+            return
+        buckets, self._buckets = self._buckets, {}
+        items = list(buckets.items())
+        ops = [
+            UpdateOne({'user_id': user_id, 'hour': hour}, {'$inc': inc}, upsert=True)
+            for (user_id, hour), inc in items
+        ]
+        try:
+            await collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+            logger.error(f"Activity bucket flush failed for {len(failed)} of {len(ops)} buckets, will retry them: {e}")
+            for index in sorted(failed):
+                key, inc = items[index]
+                bucket = self._buckets.setdefault(key, {})
+                for field, amount in inc.items():
+                    bucket[field] = bucket.get(field, 0) + amount
+            raise
+        except Exception as e:
+            logger.error(f"Activity bucket flush of {len(ops)} buckets failed, increments dropped: {e}")
+            raise
+
+    async def run(self, collection, buckets_collection, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.shield(self.flush(collection, buckets_collection))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Periodic activity flush failed: {e}")
+
+
+activity_aggregator = ActivityAggregator()
@@ -0,0 +1,52 @@
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 300))
+AUTH_CACHE_MAX_USERS = int(os.getenv("AUTH_CACHE_MAX_USERS", 50000))
+
+MISSING = object()
+
+
+class AuthCache:
+    """
+    Caches each user's status and admin flag for the handler decorators.
+    Unknown users are cached too, so repeated updates from them stay cheap.
+    Entries expire after `ttl` seconds and are invalidated by every write in db.py.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_users: int = AUTH_CACHE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: Dict[int, Tuple[float, Optional[dict]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        """Returns the cached auth record (None for unknown users), or MISSING on a miss."""
+        cached = self._entries.get(user_id)
+        if cached is None or cached[0] < time.monotonic():
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return cached[1]
+
+    def put(self, user_id: int, user: Optional[dict]):
+        if len(self._entries) >= self.max_users:
+            self._expire()
+        record = {'status': user.get('status'), 'is_admin': bool(user.get('is_admin'))} if user else None
+        self._entries[user_id] = (time.monotonic() + self.ttl, record)
+        return record
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        for user_id in [u for u, (expires, _) in self._entries.items() if expires < now]:
+            del self._entries[user_id]
+        if len(self._entries) >= self.max_users:
+            self._entries.clear()
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,194 @@
+import os
+import asyncio
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from telegram import Bot
+
+from . import db
+from .delivery import fan_out
+from .rate_limiter import lane
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+# Recipients per chunk. The cursor advances once a chunk is finished; inside a
+# chunk, finished recipients are checkpointed so a restart does not repeat them.
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 500))
+BROADCAST_CHECKPOINT_INTERVAL = 1.0
+
+
+def _pin_sender(bot: Bot, payload: dict) -> Callable[[int], Awaitable]:
+    copied: Dict[int, int] = {}
+
+    async def copy_and_pin(chat_id: int):
+        # A retry after a failed pin must not post the message a second time.
+        if chat_id not in copied:
+            sent = await bot.copy_message(chat_id=chat_id, from_chat_id=payload['from_chat_id'],
+                                          message_id=payload['message_id'])
+            copied[chat_id] = sent.message_id
+        await bot.pin_chat_message(chat_id=chat_id, message_id=copied.pop(chat_id), disable_notification=True)
+    return copy_and_pin
+
+
+def _service_sender(bot: Bot, payload: dict) -> Callable[[int], Awaitable]:
+    return lambda chat_id: bot.send_message(chat_id=chat_id, text=payload['text'])
+
+
+SENDERS = {'pin': _pin_sender, 'service': _service_sender}
+
+
+class Broadcast:
+    """
+    A message for every active user, sent in chunks of the (sorted) active
+    roster. `cursor` is the last user ID of the last finished chunk, so the
+    recipient list is never stored and users activated meanwhile are included.
+    """
+
+    def __init__(self, doc: dict):
+        self.id: ObjectId = doc['_id']
+        self.kind: str = doc['kind']
+        self.payload: dict = doc['payload']
+        self.created_by: Optional[int] = doc.get('created_by')
+        self.total: int = doc.get('total', 0)
+        self.cursor: Optional[int] = doc.get('cursor')
+        self.chunk_done: List[int] = doc.get('chunk_done', [])
+        self.sent: int = doc.get('sent', 0)
+        self.failed: int = doc.get('failed', 0)
+        self.status: str = doc.get('status', 'running')
+        self.created_at: datetime = doc.get('created_at')
+        self._checkpointed = len(self.chunk_done)
+
+    async def _save(self, **fields):
+        await db.db.broadcasts.update_one({'_id': self.id}, {'$set': {**fields, 'updated_at': datetime.utcnow()}})
+
+    async def checkpoint(self):
+        if len(self.chunk_done) != self._checkpointed:
+            self._checkpointed = len(self.chunk_done)
+            await self._save(chunk_done=list(self.chunk_done))
+
+    async def _run_checkpoints(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            try:
+                await asyncio.shield(self.checkpoint())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Checkpoint of broadcast {self.id} failed: {e}")
+
+    def _next_chunk(self, roster) -> List[int]:
+        """The next BROADCAST_CHUNK_SIZE users after the cursor, including those already done in this chunk."""
+        start = bisect_right(roster, self.cursor) if self.cursor is not None else 0
+        return list(roster[start:start + BROADCAST_CHUNK_SIZE])
+
+    async def run(self, bot: Bot):
+        send = SENDERS[self.kind](bot, self.payload)
+
+        async def send_and_track(chat_id: int):
+            await send(chat_id)
+            self.chunk_done.append(chat_id)
+
+        checkpoints = asyncio.create_task(self._run_checkpoints())
+        try:
+            with lane('bulk'), tracing.trace(f"{self.kind} broadcast {self.id}", slow_after=None):
+                while True:
+                    chunk = self._next_chunk(await db.get_active_user_ids())
+                    if not chunk:
+                        break
+                    skip = set(self.chunk_done)
+                    result = await fan_out([user_id for user_id in chunk if user_id not in skip], send_and_track,
+                                           label=f"{self.kind} broadcast {self.id}")
+                    self.cursor, self.chunk_done, self._checkpointed = chunk[-1], [], 0
+                    self.sent += result.sent + len(skip)
+                    self.failed += result.failed
+                    await self._save(cursor=self.cursor, chunk_done=[], sent=self.sent, failed=self.failed)
+            self.status = 'done'
+            await self._save(status='done', finished_at=datetime.utcnow())
+        finally:
+            checkpoints.cancel()
+            await self.checkpoint()
+        logger.info(f"Broadcast {self.id} ({self.kind}) finished: {self.sent} sent, {self.failed} failed.")
+        if self.created_by:
+            try:
+                await bot.send_message(self.created_by, f"📣 {self.kind.title()} broadcast finished. "
+                                                        f"Sent: {self.sent}, Failed: {self.failed}.")
+            except Exception as e:
+                logger.warning(f"Could not report broadcast {self.id} to {self.created_by}: {e}")
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + len(self.chunk_done)
+
+
+# Broadcasts running in this process, and their tasks, by ID.
+_running: Dict[ObjectId, Broadcast] = {}
+_tasks: Dict[ObjectId, asyncio.Task] = {}
+
+
+def _spawn(bot: Bot, broadcast: Broadcast):
+    task = asyncio.create_task(broadcast.run(bot), name=f"broadcast-{broadcast.id}")
+    _running[broadcast.id] = broadcast
+    _tasks[broadcast.id] = task
+
+    def finished(t: asyncio.Task):
+        _running.pop(broadcast.id, None)
+        _tasks.pop(broadcast.id, None)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Broadcast {broadcast.id} failed: {t.exception()}", exc_info=t.exception())
+    task.add_done_callback(finished)
+
+
+async def start(bot: Bot, kind: str, payload: dict, created_by: Optional[int] = None) -> Broadcast:
+    """Persists a new broadcast and starts sending it in the background."""
+    doc = {
+        '_id': ObjectId(), 'kind': kind, 'payload': payload, 'created_by': created_by,
+        'total': len(await db.get_active_user_ids()), 'cursor': None, 'chunk_done': [],
+        'sent': 0, 'failed': 0, 'status': 'running', 'created_at': datetime.utcnow(),
+    }
+    await db.db.broadcasts.insert_one(doc)
+    broadcast = Broadcast(doc)
+    _spawn(bot, broadcast)
+    return broadcast
+
+
+async def resume_all(bot: Bot) -> int:
+    """Restarts every broadcast that was running when the bot stopped."""
+    docs = await db.db.broadcasts.find({'status': 'running'}).sort('created_at', 1).to_list(length=None)
+    for doc in docs:
+        if doc['_id'] not in _tasks:
+            _spawn(bot, Broadcast(doc))
+    return len(docs)
+
+
+def running(kind: Optional[str] = None) -> List[Broadcast]:
+    return [broadcast for broadcast in _running.values() if kind is None or broadcast.kind == kind]
+
+
+async def recent(limit: int = 5) -> List[Broadcast]:
+    """The latest broadcasts, with live progress for the ones running here."""
+    docs = await db.db.broadcasts.find({}).sort('created_at', -1).limit(limit).to_list(length=None)
+    live = {broadcast.id: broadcast for broadcast in running()}
+    return [live.get(doc['_id']) or Broadcast(doc) for doc in docs]
+
+
+async def cancel(broadcast_id: ObjectId) -> bool:
+    result = await db.db.broadcasts.update_one(
+        {'_id': broadcast_id, 'status': 'running'},
+        {'$set': {'status': 'cancelled', 'finished_at': datetime.utcnow()}}
+    )
+    task = _tasks.get(broadcast_id)
+    if task:
+        task.cancel()
+    return result.modified_count > 0
+
+
+async def stop_all():
+    """Stops the broadcasts running here without cancelling them, so they resume after a restart."""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,24 +1,64 @@
 import os
+import asyncio
 import logging
+from array import array
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timedelta
+from pymongo.errors import OperationFailure
+
+from .roster import active_roster
+from .relay_log import relay_log_writer
+from .message_index import recent_messages
+from .auth_cache import auth_cache, MISSING
+from .activity import activity_aggregator, hour_bucket
+from .retention import archive_expired, ensure_relay_log_retention
+from .metrics import db_operation
 
 logger = logging.getLogger(__name__)
 
 client: AsyncIOMotorClient = None
 db = None
+ROSTER_CHANGE_STREAM = os.getenv("ROSTER_CHANGE_STREAM", "false").lower() in ("1", "true", "yes")
+RELAY_LOG_FLUSH_INTERVAL = float(os.getenv("RELAY_LOG_FLUSH_INTERVAL", 2))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", 30))
+# Hourly activity buckets older than this are expired by a TTL index.
+ACTIVITY_BUCKET_RETENTION_DAYS = float(os.getenv("ACTIVITY_BUCKET_RETENTION_DAYS", 35))
+# Ranking used by /stats and the summaries. user_id breaks ties, so (media_sent_count, user_id) is a stable page cursor.
+TOP_USERS_SORT = [("media_sent_count", -1), ("user_id", 1)]
+# User IDs per update_many when changing many statuses at once.
+BULK_STATUS_CHUNK = 10000
+_background_tasks = []
 
+@db_operation
 async def init_database(mongo_uri: str, db_name: str, admin_ids_str: str):
     global client, db
     client = AsyncIOMotorClient(mongo_uri)
     db = client[db_name]
     logger.info(f"Connected to MongoDB: '{db_name}'")
     await db.users.create_index("user_id", unique=True)
-    await db.messages.create_index("original_message_id", unique=True)
-    await db.messages.create_index("relayed_to_flat")
+    await db.users.create_index("status")
+    await db.users.create_index(TOP_USERS_SORT)
+    await db.users.create_index([("status", 1), ("is_whitelisted", 1), ("last_active", 1)])
+    await db.activity_hourly.create_index([("user_id", 1), ("hour", 1)], unique=True)
+    await db.activity_hourly.create_index("hour", expireAfterSeconds=int(ACTIVITY_BUCKET_RETENTION_DAYS * 86400))
+    await db.config.update_one(
+        {'_id': 'activity_buckets_since'}, {'$setOnInsert': {'value': datetime.utcnow()}}, upsert=True
+    )
+    await db.relay_map.create_index([("chat_id", 1), ("message_id", 1)], unique=True)
+    await db.relay_map.create_index([("sender_id", 1), ("original_message_id", 1)])
+    await db.relay_map.create_index(
+        [("sender_id", 1), ("group_id", 1)], partialFilterExpression={'group_id': {'$exists': True}}
+    )
+    await ensure_relay_log_retention(db.relay_map)
+    await db.outbox.create_index("created_at")
+    await db.broadcasts.create_index([("status", 1), ("created_at", 1)])
+    await db.broadcasts.create_index("created_at")
+    await db.media_buffer.create_index([("sender_id", 1), ("message_id", 1)], unique=True)
+    await db.media_buffer.create_index("received_at")
     try:
         admin_ids = [int(i.strip()) for i in admin_ids_str.split(',')]
         for admin_id in admin_ids:
+            auth_cache.invalidate(admin_id)
             await db.users.update_one(
                 {'user_id': admin_id},
                 {'$set': {'is_admin': True, 'is_whitelisted': True, 'status': 'active'},
@@ -32,7 +72,24 @@ async def init_database(mongo_uri: str, db_name: str, admin_ids_str: str):
         logger.info(f"Initial admins processed: {admin_ids}")
     except ValueError:
         logger.error("INITIAL_ADMIN_IDS is invalid.")
+    await active_roster.load(db.users)
+    _background_tasks.append(asyncio.create_task(relay_log_writer.run(db.relay_map, RELAY_LOG_FLUSH_INTERVAL)))
+    _background_tasks.append(asyncio.create_task(activity_aggregator.run(db.users, db.activity_hourly, ACTIVITY_FLUSH_INTERVAL)))
+    if ROSTER_CHANGE_STREAM:
+        _background_tasks.append(asyncio.create_task(active_roster.watch(db.users)))
+
+@db_operation
+async def close_database():
+    """Stops background tasks and flushes every buffered write."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await flush_relay_log()
+    await flush_activity()
+    client.close()
 
+@db_operation
 async def add_user(user_id: int, full_name: str, username: str):
     await db.users.insert_one({
         'user_id': user_id, 'full_name': full_name, 'username': username,
@@ -40,69 +97,301 @@ async def add_user(user_id: int, full_name: str, username: str):
         'join_date': datetime.utcnow(), 'last_active': datetime.utcnow(),
         'media_sent_count': 0, 'total_messages_sent': 0,
     })
+    auth_cache.invalidate(user_id)
 
+@db_operation
 async def get_user(user_id: int):
-    return await db.users.find_one({'user_id': user_id})
+    return activity_aggregator.overlay(await db.users.find_one({'user_id': user_id}))
+
+async def get_user_auth(user_id: int):
+    """
+    Returns {'status', 'is_admin'} for a user, or None if they are not registered.
+    Served from the auth cache whenever possible.
+    """
+    record = auth_cache.get(user_id)
+    if record is MISSING:
+        record = auth_cache.put(user_id, await _find_user_auth(user_id))
+    return record
+
+@db_operation
+async def _find_user_auth(user_id: int):
+    return await db.users.find_one({'user_id': user_id}, {'status': 1, 'is_admin': 1, '_id': 0})
+
+@db_operation
+async def get_user_totals():
+    """Counts users per status and sums their messages in one server-side pass."""
+    await flush_activity()
+    totals = {'total': 0, 'messages': 0, 'by_status': {}}
+    pipeline = [{'$group': {'_id': '$status', 'count': {'$sum': 1}, 'messages': {'$sum': '$total_messages_sent'}}}]
+    async for row in db.users.aggregate(pipeline):
+        totals['by_status'][row['_id']] = row['count']
+        totals['total'] += row['count']
+        totals['messages'] += row['messages']
+    return totals
 
-async def get_all_users():
-    return await db.users.find({}).to_list(length=None)
+@db_operation
+async def get_top_users(limit: int, after: tuple = None, before: tuple = None):
+    """
+    Returns one page of users ranked by media sent. `after` and `before` are
+    the (media_sent_count, user_id) of the row the page starts after or ends
+    before, so every page is an index range scan however deep it is.
+    """
+    await flush_activity()
+    projection = {'_id': 0, 'user_id': 1, 'full_name': 1, 'username': 1, 'media_sent_count': 1}
+    if before:
+        media, user_id = before
+        query = {'$or': [{'media_sent_count': {'$gt': media}}, {'media_sent_count': media, 'user_id': {'$lt': user_id}}]}
+        reverse_sort = [(field, -direction) for field, direction in TOP_USERS_SORT]
+        users = await db.users.find(query, projection).sort(reverse_sort).limit(limit).to_list(length=None)
+        users.reverse()
+        return users
+    query = {}
+    if after:
+        media, user_id = after
+        query = {'$or': [{'media_sent_count': {'$lt': media}}, {'media_sent_count': media, 'user_id': {'$gt': user_id}}]}
+    return await db.users.find(query, projection).sort(TOP_USERS_SORT).limit(limit).to_list(length=None)
 
-async def get_all_active_users():
-    return await db.users.find({'status': 'active'}).to_list(length=None)
+async def get_active_user_ids() -> array:
+    """Returns the cached roster of active user IDs. Only the first call touches MongoDB."""
+    if not active_roster.loaded:
+        await _load_active_roster()
+    return active_roster.snapshot()
 
+@db_operation
+async def _load_active_roster():
+    await active_roster.load(db.users)
+
+@db_operation
 async def update_user_status(user_id: int, status: str):
     await db.users.update_one({'user_id': user_id}, {'$set': {'status': status}})
+    auth_cache.invalidate(user_id)
+    active_roster.apply_status(user_id, status)
     
+@db_operation
+async def deactivate_users(user_ids) -> int:
+    """Marks many active users inactive with a few update_many calls. Returns how many changed."""
+    user_ids = list(user_ids)
+    modified = 0
+    for i in range(0, len(user_ids), BULK_STATUS_CHUNK):
+        result = await db.users.update_many(
+            {'user_id': {'$in': user_ids[i:i + BULK_STATUS_CHUNK]}, 'status': 'active'},
+            {'$set': {'status': 'inactive'}}
+        )
+        modified += result.modified_count
+    for user_id in user_ids:
+        auth_cache.invalidate(user_id)
+    active_roster.discard_many(user_ids)
+    return modified
+
+@db_operation
 async def update_user_info(user_id: int, full_name: str, username: str):
     await db.users.update_one({'user_id': user_id}, {'$set': {'full_name': full_name, 'username': username}})
 
+@db_operation
 async def set_admin_status(user_id: int, is_admin: bool):
     await db.users.update_one({'user_id': user_id}, {'$set': {'is_admin': is_admin}})
+    auth_cache.invalidate(user_id)
 
+@db_operation
 async def set_whitelist_status(user_id: int, is_whitelisted: bool):
     await db.users.update_one({'user_id': user_id}, {'$set': {'is_whitelisted': is_whitelisted}})
 
 async def is_admin(user_id: int) -> bool:
-    user = await get_user(user_id)
-    return bool(user and user.get('is_admin'))
+    user = await get_user_auth(user_id)
+    return bool(user and user['is_admin'])
 
 async def update_last_active(user_id: int):
-    await db.users.update_one({'user_id': user_id}, {'$set': {'last_active': datetime.utcnow()}})
+    activity_aggregator.touch(user_id)
+
+@db_operation
+async def flush_activity():
+    await activity_aggregator.flush(db.users, db.activity_hourly)
 
-async def find_inactive_users(days: int):
+@db_operation
+async def find_inactive_users(days: int, min_media: int):
+    """
+    Returns active, non-whitelisted users who joined more than `days` ago and
+    sent fewer than `min_media` media in the last `days` days. The window is
+    summed from hourly buckets. Until the buckets cover a full window (right
+    after they were introduced), users idle for `days` are returned instead.
+    """
+    await flush_activity()
     cutoff = datetime.utcnow() - timedelta(days=days)
-    return await db.users.find({'last_active': {'$lt': cutoff}, 'is_whitelisted': False, 'status': 'active'}).to_list(length=None)
+    buckets_since = await get_config_value('activity_buckets_since')
+    if not buckets_since or buckets_since > cutoff:
+        return await db.users.find(
+            {'last_active': {'$lt': cutoff}, 'is_whitelisted': False, 'status': 'active'}, {'_id': 0, 'user_id': 1}
+        ).to_list(length=None)
+    pipeline = [
+        {'$match': {'hour': {'$gte': hour_bucket(cutoff)}, 'media_sent_count': {'$gt': 0}}},
+        {'$group': {'_id': '$user_id', 'media': {'$sum': '$media_sent_count'}}},
+        {'$match': {'media': {'$gte': min_media}}},
+    ]
+    qualified = {row['_id'] async for row in db.activity_hourly.aggregate(pipeline)}
+    candidates = db.users.find(
+        {'status': 'active', 'is_whitelisted': False, 'join_date': {'$lt': cutoff}}, {'_id': 0, 'user_id': 1}
+    )
+    return [user async for user in candidates if user['user_id'] not in qualified]
+
+@db_operation
+async def get_activity_summary(days: float, top: int = 10):
+    """
+    Sums media and messages over the last `days` days from the hourly
+    buckets, and ranks the `top` users by media sent in that window.
+    """
+    await flush_activity()
+    since = hour_bucket(datetime.utcnow() - timedelta(days=days))
+    pipeline = [
+        {'$match': {'hour': {'$gte': since}}},
+        {'$group': {'_id': '$user_id', 'media': {'$sum': '$media_sent_count'}, 'messages': {'$sum': '$total_messages_sent'}}},
+        {'$facet': {
+            'totals': [{'$group': {'_id': None, 'users': {'$sum': 1}, 'media': {'$sum': '$media'}, 'messages': {'$sum': '$messages'}}}],
+            'top': [{'$match': {'media': {'$gt': 0}}}, {'$sort': {'media': -1, '_id': 1}}, {'$limit': top}],
+        }},
+    ]
+    result = (await db.activity_hourly.aggregate(pipeline).to_list(None))[0]
+    totals = result['totals'][0] if result['totals'] else {'users': 0, 'media': 0, 'messages': 0}
+    names = {
+        user['user_id']: user
+        async for user in db.users.find({'user_id': {'$in': [row['_id'] for row in result['top']]}},
+                                        {'_id': 0, 'user_id': 1, 'full_name': 1, 'username': 1})
+    }
+    return {
+        'active_users': totals['users'], 'media': totals['media'], 'messages': totals['messages'],
+        'top': [{**names.get(row['_id'], {'user_id': row['_id']}), 'media': row['media'], 'messages': row['messages']}
+                for row in result['top']],
+    }
 
 async def increment_user_stat(user_id: int, media_count: int = 0, message_count: int = 0):
-    inc_doc = {}
-    if media_count > 0: inc_doc['media_sent_count'] = media_count
-    if message_count > 0: inc_doc['total_messages_sent'] = message_count
-    if inc_doc: await db.users.update_one({'user_id': user_id}, {'$inc': inc_doc})
-
-async def log_relayed_message(original_msg_id: int, sender_id: int, relayed_to: dict):
-    relayed_to_flat = [f"{chat_id}_{msg_id}" for chat_id, msg_id in relayed_to.items()]
-    await db.messages.update_one(
-        {'original_message_id': original_msg_id},
-        {
-            '$set': {'sender_id': sender_id, 'timestamp': datetime.utcnow()},
-            '$addToSet': {'relayed_to_flat': {'$each': relayed_to_flat}},
-            '$inc': {f'relayed_to.{k}': v for k, v in relayed_to.items()}
-        },
-        upsert=True
+    if media_count > 0: activity_aggregator.increment(user_id, 'media_sent_count', media_count)
+    if message_count > 0: activity_aggregator.increment(user_id, 'total_messages_sent', message_count)
+
+async def log_relayed_message(original_msg_id: int, sender_id: int, relayed_to: dict, group_id: int = None):
+    """Buffers a mapping. It is written by the next flush_relay_log() or the periodic flush."""
+    relay_log_writer.add(original_msg_id, sender_id, relayed_to, group_id)
+    recent_messages.record(original_msg_id, sender_id, relayed_to)
+
+@db_operation
+async def flush_relay_log():
+    await relay_log_writer.flush(db.relay_map)
+
+def _merge_pending(message_log, original_msg_id: int, sender_id: int):
+    pending = relay_log_writer.get(sender_id, original_msg_id)
+    if pending is None:
+        return message_log
+    if not message_log:
+        message_log = {'original_message_id': original_msg_id, 'sender_id': sender_id, 'relayed_to': {}}
+    return {**message_log, 'relayed_to': {**message_log['relayed_to'], **pending}}
+
+async def get_relayed_message_info_by_original_id(original_msg_id: int, sender_id: int):
+    """Returns the message with every relayed copy as relayed_to: {chat_id: message_id}."""
+    message_log = recent_messages.get(sender_id, original_msg_id)
+    if message_log:
+        return message_log
+    copies = await _find_relayed_copies(original_msg_id, sender_id)
+    message_log = None
+    if copies:
+        message_log = {
+            'original_message_id': original_msg_id, 'sender_id': sender_id,
+            'relayed_to': {doc['chat_id']: doc['message_id'] for doc in copies if doc['chat_id'] != sender_id}
+        }
+    message_log = _merge_pending(message_log, original_msg_id, sender_id)
+    if message_log:
+        recent_messages.put(message_log)
+    return message_log
+
+@db_operation
+async def _find_relayed_copies(original_msg_id: int, sender_id: int) -> list:
+    return await db.relay_map.find(
+        {'sender_id': sender_id, 'original_message_id': original_msg_id},
+        {'_id': 0, 'chat_id': 1, 'message_id': 1}
+    ).to_list(None)
+
+async def get_message_origin(chat_id: int, message_id: int):
+    """
+    Resolves any message the bot relayed, or its original in the sender's
+    chat, to (sender_id, original_message_id) with a single small lookup.
+    """
+    message_log = recent_messages.get_by_relayed(chat_id, message_id)
+    if message_log:
+        return message_log['sender_id'], message_log['original_message_id']
+    origin = relay_log_writer.original_for_relayed(chat_id, message_id)
+    if origin:
+        return origin
+    doc = await _find_message_origin(chat_id, message_id)
+    return (doc['sender_id'], doc['original_message_id']) if doc else None
+
+@db_operation
+async def _find_message_origin(chat_id: int, message_id: int):
+    return await db.relay_map.find_one(
+        {'chat_id': chat_id, 'message_id': message_id}, {'_id': 0, 'sender_id': 1, 'original_message_id': 1}
     )
-    
-async def get_relayed_message_info_by_original_id(original_msg_id: int):
-    return await db.messages.find_one({'original_message_id': original_msg_id})
 
 async def get_relayed_message_info_by_relayed_id(chat_id: int, message_id: int):
-    return await db.messages.find_one({'relayed_to_flat': f"{chat_id}_{message_id}"})
+    origin = await get_message_origin(chat_id, message_id)
+    if not origin:
+        return None
+    sender_id, original_msg_id = origin
+    return await get_relayed_message_info_by_original_id(original_msg_id, sender_id)
+
+@db_operation
+async def get_message_group(original_msg_id: int, sender_id: int):
+    """
+    Returns every copy of a message, or of the whole album it was relayed in,
+    as {'original_message_ids': [...], 'copies': {chat_id: [message_id, ...]}}.
+    The sender's own originals are included in `copies`.
+    """
+    await flush_relay_log()
+    own = await db.relay_map.find_one({'chat_id': sender_id, 'message_id': original_msg_id}, {'_id': 0, 'group_id': 1})
+    query = {'sender_id': sender_id}
+    if own and own.get('group_id') is not None:
+        query['group_id'] = own['group_id']
+    else:
+        query['original_message_id'] = original_msg_id
+    copies, originals = {}, set()
+    async for doc in db.relay_map.find(query, {'_id': 0, 'chat_id': 1, 'message_id': 1, 'original_message_id': 1}):
+        copies.setdefault(doc['chat_id'], []).append(doc['message_id'])
+        originals.add(doc['original_message_id'])
+    return {'original_message_ids': sorted(originals), 'copies': copies}
+
+@db_operation
+async def delete_relayed_message_log(original_msg_id: int, sender_id: int):
+    relay_log_writer.discard(sender_id, original_msg_id)
+    recent_messages.discard(sender_id, original_msg_id)
+    await db.relay_map.delete_many({'sender_id': sender_id, 'original_message_id': original_msg_id})
+
+@db_operation
+async def archive_relay_logs():
+    await flush_relay_log()
+    return await archive_expired(db.relay_map)
+
+async def _collection_stats(name: str) -> dict:
+    try:
+        result = await db[name].aggregate([{'$collStats': {'storageStats': {}}}]).to_list(None)
+        stats = result[0]['storageStats']
+    except OperationFailure:
+        stats = await db.command('collStats', name)
+    return {
+        'name': name, 'count': stats.get('count', 0), 'size': stats.get('size', 0),
+        'storage_size': stats.get('storageSize', 0), 'index_size': stats.get('totalIndexSize', 0),
+        'indexes': stats.get('indexSizes', {}),
+    }
 
-async def delete_relayed_message_log(original_msg_id: int):
-    await db.messages.delete_one({'original_message_id': original_msg_id})
+@db_operation
+async def get_storage_stats():
+    """Returns per-collection document counts and data/index sizes, plus database totals."""
+    collections = [await _collection_stats(name) for name in sorted(await db.list_collection_names())]
+    totals = await db.command('dbStats')
+    return {
+        'collections': collections, 'data_size': totals.get('dataSize', 0),
+        'storage_size': totals.get('storageSize', 0), 'index_size': totals.get('indexSize', 0),
+    }
 
+@db_operation
 async def set_config_value(key: str, value):
     await db.config.update_one({'_id': key}, {'$set': {'value': value}}, upsert=True)
 
+@db_operation
 async def get_config_value(key: str):
     doc = await db.config.find_one({'_id': key})
     return doc.get('value') if doc else None
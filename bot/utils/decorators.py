@@ -24,7 +24,7 @@ def user_is_registered(func):
     """Decorator to ensure a user exists in the database."""
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = await db.get_user(update.effective_user.id)
+        user = await db.get_user_auth(update.effective_user.id)
         if user:
             return await func(update, context, *args, **kwargs)
         else:
@@ -36,7 +36,7 @@ def user_is_active(func):
     """Decorator to check if a user's status is 'active' before processing messages."""
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = await db.get_user(update.effective_user.id)
+        user = await db.get_user_auth(update.effective_user.id)
         if user and user.get('status') == 'active':
             return await func(update, context, *args, **kwargs)
         elif user and user.get('status') == 'banned':
@@ -0,0 +1,180 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from . import db
+from .metrics import FANOUT_DURATION, SEND_FAILURES, SEND_LATENCY, SEND_OUTCOMES
+from .rate_limiter import caller_retries, current_lane
+from .scheduler import relay_scheduler
+
+logger = logging.getLogger(__name__)
+
+# How many chats are served at once. The rate limiter keeps the actual send rate within Telegram's limits.
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", 32))
+# Transient failures (flood waits, timeouts, network errors) are re-queued with exponential backoff.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RELAY_RETRY_MAX_ATTEMPTS", 4))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Failure reasons across all fan-outs since startup.
+FAILURE_HISTOGRAM: Counter = Counter()
+
+
+def failure_reason(error: Exception) -> str:
+    if isinstance(error, Forbidden): return 'forbidden'
+    if isinstance(error, RetryAfter): return 'retry_after'
+    if isinstance(error, TimedOut): return 'timed_out'
+    if isinstance(error, BadRequest): return 'bad_request'
+    if isinstance(error, NetworkError): return 'network_error'
+    return type(error).__name__
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Exponential backoff with full jitter, never shorter than a flood wait Telegram asked for."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if isinstance(error, RetryAfter):
+        retry_after = error.retry_after
+        delay += retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+    return delay
+
+
+@dataclass
+class FanOutResult:
+    label: str
+    recipients: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    forbidden: List[int] = field(default_factory=list)
+    failures: Counter = field(default_factory=Counter)
+    results: Dict[int, Any] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        summary = (f"Fan-out '{self.label}': {self.sent}/{self.recipients} sent, {self.failed} failed, "
+                   f"{self.retried} retries in {self.elapsed:.2f}s ({self.rate:.1f}/s)")
+        if self.failures:
+            summary += f" failures: {dict(self.failures)}"
+        return summary
+
+
+async def fan_out(chat_ids: Iterable[int], send: Callable[[int], Awaitable[Any]], label: str,
+                  demote_forbidden: bool = True, concurrency: int = FANOUT_CONCURRENCY,
+                  on_progress: Optional[Callable[[FanOutResult], Awaitable[Any]]] = None,
+                  progress_interval: float = 30.0, flow: Optional[Hashable] = None) -> FanOutResult:
+    """
+    Calls `send(chat_id)` for every chat using a bounded pool of workers.
+    The return value of each successful send is kept in `results`. Transient
+    errors are retried later with backoff (the rate limiter does not retry
+    them itself), so `send` must be safe to call again.
+    Chats that blocked the bot are collected in `forbidden` and, by default,
+    marked inactive. `on_progress(result)` is awaited every `progress_interval`
+    seconds while the fan-out runs. With a `flow` (the sender), every send
+    waits for a slot of the shared relay scheduler, which interleaves senders.
+    """
+    chat_ids = list(chat_ids)
+    result = FanOutResult(label=label, recipients=len(chat_ids))
+    queue: asyncio.Queue = asyncio.Queue()
+    for chat_id in chat_ids:
+        queue.put_nowait((chat_id, 0))
+    outstanding = len(chat_ids)
+    finished = asyncio.Event()
+    retry_timers = []
+    lane = current_lane.get()
+    started = time.monotonic()
+
+    async def report_progress():
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(finished.wait(), progress_interval)
+            except asyncio.TimeoutError:
+                result.elapsed = time.monotonic() - started
+                try:
+                    await on_progress(result)
+                except Exception as e:
+                    logger.warning(f"Progress report for {label} failed: {e}")
+
+    def settle():
+        nonlocal outstanding
+        outstanding -= 1
+        if flow is not None:
+            relay_scheduler.backlog[flow] -= 1
+        if outstanding == 0:
+            finished.set()
+
+    def record_failure(chat_id: int, reason: str):
+        result.failed += 1
+        result.failures[reason] += 1
+        FAILURE_HISTOGRAM[reason] += 1
+        SEND_FAILURES.inc(reason)
+        SEND_OUTCOMES.inc(lane, 'failed')
+        if reason == 'forbidden':
+            result.forbidden.append(chat_id)
+
+    async def worker():
+        # Flood waits are backed off below, with the worker and scheduler slot released meanwhile.
+        caller_retries.set(True)
+        while True:
+            chat_id, attempt = await queue.get()
+            send_started = time.monotonic()
+            try:
+                if flow is None:
+                    result.results[chat_id] = await send(chat_id)
+                else:
+                    async with relay_scheduler.slot(flow):
+                        result.results[chat_id] = await send(chat_id)
+                result.sent += 1
+                SEND_LATENCY.observe(time.monotonic() - send_started, lane)
+                SEND_OUTCOMES.inc(lane, 'sent')
+            except (RetryAfter, TimedOut, NetworkError) as e:
+                if isinstance(e, BadRequest) or attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                    record_failure(chat_id, failure_reason(e))
+                    logger.error(f"Failed {label} to {chat_id}: {e}")
+                else:
+                    result.retried += 1
+                    retry_timers.append(asyncio.get_running_loop().call_later(
+                        retry_delay(e, attempt), queue.put_nowait, (chat_id, attempt + 1)
+                    ))
+                    continue
+            except Exception as e:
+                record_failure(chat_id, failure_reason(e))
+                if not isinstance(e, Forbidden):
+                    logger.error(f"Failed {label} to {chat_id}: {e}")
+            settle()
+
+    if chat_ids and flow is not None:
+        relay_scheduler.backlog[flow] += len(chat_ids)
+    if chat_ids:
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(chat_ids)))]
+        if on_progress:
+            workers.append(asyncio.create_task(report_progress()))
+        try:
+            await finished.wait()
+        finally:
+            for timer in retry_timers:
+                timer.cancel()
+            for task in workers:
+                task.cancel()
+            if flow is not None:
+                relay_scheduler.backlog[flow] -= outstanding
+                if relay_scheduler.backlog[flow] <= 0:
+                    del relay_scheduler.backlog[flow]
+    result.elapsed = time.monotonic() - started
+
+    if demote_forbidden and result.forbidden:
+        await db.deactivate_users(result.forbidden)
+    if chat_ids:
+        FANOUT_DURATION.observe(result.elapsed, lane)
+        logger.info(result.summary())
+    return result
@@ -21,12 +21,12 @@ async def get_user_id_from_command(message: Message) -> Union[int, None]:
     if message.reply_to_message:
         replied_message_id = message.reply_to_message.message_id
         # Find the message log based on the replied-to message in the admin's chat
-        message_log = await db.get_relayed_message_info_by_relayed_id(
+        origin = await db.get_message_origin(
             chat_id=message.chat_id, 
             message_id=replied_message_id
         )
-        if message_log:
-            return message_log.get('sender_id')
+        if origin:
+            return origin[0]
 
         # Fallback for old messages that might not have the new index
         text_to_check = message.reply_to_message.text or message.reply_to_message.caption
@@ -0,0 +1,115 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Message
+
+from .render import MAX_ALBUM_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Single photos, videos and documents from one sender are relayed together once
+# no new one arrived for this long...
+MEDIA_BUFFER_IDLE = float(os.getenv("MEDIA_BUFFER_IDLE", 2.0))
+# ...or this long after the first one was buffered, whichever comes first.
+MEDIA_BUFFER_MAX_WAIT = float(os.getenv("MEDIA_BUFFER_MAX_WAIT", 5.0))
+
+
+class _SenderBuffer:
+    __slots__ = ('messages', 'started', 'idle_timer', 'deadline_timer')
+
+    def __init__(self):
+        self.messages: List[Message] = []
+        self.started = time.monotonic()
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.deadline_timer: Optional[asyncio.TimerHandle] = None
+
+
+class MediaDispatcher:
+    """
+    Per-sender media buffers that hand their contents to
+    `dispatch(sender_id, messages)` as soon as they are worth relaying: when
+    a complete album is added, when MAX_ALBUM_SIZE items are waiting, after
+    `idle` seconds without new media or `max_wait` seconds after the first
+    item. Nothing runs while no media arrives. A sender's relays run one
+    after another, so every recipient gets their media in the order it was
+    sent. Must be used from the event loop.
+    """
+
+    def __init__(self, dispatch: Callable[[int, List[Message]], Awaitable], idle: float = MEDIA_BUFFER_IDLE,
+                 max_wait: float = MEDIA_BUFFER_MAX_WAIT):
+        self.dispatch = dispatch
+        self.idle = idle
+        self.max_wait = max_wait
+        self._buffers: Dict[int, _SenderBuffer] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # The latest relay of each sender with one queued or running.
+        self._last_relay: Dict[int, asyncio.Task] = {}
+        self.flushes: Counter = Counter()
+        self.latencies = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def add(self, sender_id: int, messages: List[Message], complete: bool = False):
+        """Buffers media from a sender. `complete` marks an assembled album, which is dispatched right away."""
+        if not messages:
+            return
+        loop = asyncio.get_running_loop()
+        buffer = self._buffers.get(sender_id)
+        if buffer is None:
+            buffer = self._buffers[sender_id] = _SenderBuffer()
+            buffer.deadline_timer = loop.call_later(self.max_wait, self.flush, sender_id, 'deadline')
+        buffer.messages.extend(messages)
+
+        if complete or len(buffer.messages) >= MAX_ALBUM_SIZE:
+            self.flush(sender_id, 'album' if complete else 'full')
+        else:
+            if buffer.idle_timer:
+                buffer.idle_timer.cancel()
+            buffer.idle_timer = loop.call_later(self.idle, self.flush, sender_id, 'idle')
+
+    def flush(self, sender_id: int, reason: str = 'manual'):
+        buffer = self._buffers.pop(sender_id, None)
+        if buffer is None:
+            return
+        for timer in (buffer.idle_timer, buffer.deadline_timer):
+            if timer:
+                timer.cancel()
+        self.flushes[reason] += 1
+        self.latencies.append(time.monotonic() - buffer.started)
+        task = asyncio.create_task(self._relay_after(self._last_relay.get(sender_id), sender_id, buffer.messages),
+                                   name=f"relay-media-{sender_id}")
+        self._tasks.add(task)
+        self._last_relay[sender_id] = task
+        task.add_done_callback(lambda task: self._finished(sender_id, task))
+
+    async def _relay_after(self, previous: Optional[asyncio.Task], sender_id: int, messages: List[Message]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.dispatch(sender_id, messages)
+
+    def _finished(self, sender_id: int, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._last_relay.get(sender_id) is task:
+            del self._last_relay[sender_id]
+        if not task.cancelled() and task.exception():
+            logger.error(f"Media relay task {task.get_name()} failed: {task.exception()}", exc_info=task.exception())
+
+    def flush_all(self):
+        for sender_id in list(self._buffers):
+            self.flush(sender_id)
+
+    def stats(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        return {
+            'buffered_senders': len(self._buffers),
+            'buffered_items': sum(len(buffer.messages) for buffer in self._buffers.values()),
+            'relays_running': len(self._tasks),
+            'wait_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'wait_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            **{f'flushed_{reason}': count for reason, count in self.flushes.items()},
+        }
@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+from telegram import Message
+
+from .render import MAX_ALBUM_SIZE
+
+logger = logging.getLogger(__name__)
+
+# A group is complete once no new part arrived for this long...
+MEDIA_GROUP_IDLE = float(os.getenv("MEDIA_GROUP_IDLE", 1.0))
+# ...or this long after its first part, whichever comes first.
+MEDIA_GROUP_DEADLINE = float(os.getenv("MEDIA_GROUP_DEADLINE", 10))
+# Upper bound on parts held across all open groups. The oldest group is flushed beyond it.
+MEDIA_GROUP_MAX_PARTS = int(os.getenv("MEDIA_GROUP_MAX_PARTS", 2000))
+# Flushed group IDs remembered to detect parts that arrive too late (split albums).
+RECENT_GROUPS = 5000
+
+
+class _OpenGroup:
+    __slots__ = ('sender_id', 'messages', 'started', 'idle_timer', 'deadline_timer')
+
+    def __init__(self, sender_id: int):
+        self.sender_id = sender_id
+        self.messages: List[Message] = []
+        self.started = time.monotonic()
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.deadline_timer: Optional[asyncio.TimerHandle] = None
+
+
+class MediaGroupAssembler:
+    """
+    Collects the parts of Telegram media groups (albums), which arrive as
+    separate updates. A group is handed to `on_complete(sender_id, messages)`
+    when it has been idle for `idle` seconds, reaches MAX_ALBUM_SIZE parts, or
+    is `deadline` seconds old. Must be used from the event loop.
+    """
+
+    def __init__(self, on_complete: Callable[[int, List[Message]], None], idle: float = MEDIA_GROUP_IDLE,
+                 deadline: float = MEDIA_GROUP_DEADLINE, max_parts: int = MEDIA_GROUP_MAX_PARTS):
+        self.on_complete = on_complete
+        self.idle = idle
+        self.deadline = deadline
+        self.max_parts = max_parts
+        self._groups: "OrderedDict[str, _OpenGroup]" = OrderedDict()
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._parts = 0
+        self.flushes: Counter = Counter()
+        self.groups_split = 0
+        self.latencies = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, message: Message):
+        group_id = message.media_group_id
+        group = self._groups.get(group_id)
+        if group is None:
+            if group_id in self._recent:
+                # The rest of this album was already flushed: it will be relayed as two albums.
+                self.groups_split += 1
+                del self._recent[group_id]
+                logger.info(f"Media group {group_id} from {message.chat_id} arrived late and was split.")
+            group = self._groups[group_id] = _OpenGroup(message.chat_id)
+            group.deadline_timer = asyncio.get_running_loop().call_later(self.deadline, self.flush, group_id, 'deadline')
+        group.messages.append(message)
+        self._parts += 1
+
+        if len(group.messages) >= MAX_ALBUM_SIZE:
+            self.flush(group_id, 'full')
+        else:
+            if group.idle_timer:
+                group.idle_timer.cancel()
+            group.idle_timer = asyncio.get_running_loop().call_later(self.idle, self.flush, group_id, 'idle')
+        while self._parts > self.max_parts and self._groups:
+            self.flush(next(iter(self._groups)), 'memory')
+
+    def flush(self, group_id: str, reason: str = 'manual'):
+        group = self._groups.pop(group_id, None)
+        if group is None:
+            return
+        for timer in (group.idle_timer, group.deadline_timer):
+            if timer:
+                timer.cancel()
+        self._parts -= len(group.messages)
+        self._recent[group_id] = None
+        while len(self._recent) > RECENT_GROUPS:
+            self._recent.popitem(last=False)
+        self.flushes[reason] += 1
+        self.latencies.append(time.monotonic() - group.started)
+        if reason in ('deadline', 'memory'):
+            logger.warning(f"Media group {group_id} flushed by {reason} with {len(group.messages)} parts.")
+        # Parts can be added out of order; the album keeps the order they were sent in.
+        self.on_complete(group.sender_id, sorted(group.messages, key=lambda message: message.message_id))
+
+    def flush_all(self):
+        for group_id in list(self._groups):
+            self.flush(group_id)
+
+    def stats(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        assembled = sum(self.flushes.values())
+        return {
+            'open_groups': len(self._groups),
+            'open_parts': self._parts,
+            'assembled': assembled,
+            'split': self.groups_split,
+            'split_rate': self.groups_split / assembled if assembled else 0.0,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            **{f'flushed_{reason}': count for reason, count in self.flushes.items()},
+        }
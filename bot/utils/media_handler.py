@@ -1,183 +1,194 @@
+import time
 import logging
 import asyncio
-from collections import defaultdict
-from typing import List, Dict, Any
-from datetime import datetime
-from telegram import Update, Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from typing import List, Dict, Optional
+from telegram import Bot, Update, Message
 from telegram.ext import ContextTypes
-from telegram.error import Forbidden, TimedOut
 
-from . import db
+from . import db, outbox, sharding
+from .delivery import fan_out
+from .render import AlbumPayload, TextPayload, render_albums, render_text
 from .decorators import user_is_active
+from .media_groups import MediaGroupAssembler
+from .media_dispatch import MediaDispatcher
+from .rate_limiter import lane
+from . import tracing
 
 logger = logging.getLogger(__name__)
 
-MEDIA_BUFFER = defaultdict(list)
-PROCESSED_MEDIA_GROUPS = set()
-MAX_ALBUM_SIZE = 10
-RELAY_BATCH_SIZE = 10
-RELAY_BATCH_DELAY = 3
-
-async def _send_user_media_job(context: ContextTypes.DEFAULT_TYPE):
+async def _relay_media(sender_id: int, messages: List[Message]):
     """
-    This is the worker job that does the heavy lifting of sending media albums.
-    It's triggered as a one-off job by the dispatcher.
+    Does the heavy lifting of sending a sender's buffered media as albums.
+    Started by the media dispatcher as soon as the buffer is ready.
     """
-    job_data = context.job.data
-    sender_id: int = job_data["sender_id"]
-    messages: List[Message] = job_data["messages"]
-    
-    recipients = await db.get_all_active_users()
-    if not recipients:
-        return
-        
-    # --- 1. Group messages by type and order to preserve sequence ---
-    all_albums_to_send: List[Dict[str, Any]] = []
-    current_album_messages: List[Message] = []
-    
-    for msg in messages:
-        is_new_album = False
-        if not current_album_messages:
-            is_new_album = True
-        else:
-            first_msg_in_album = current_album_messages[0]
-            is_pv_album = first_msg_in_album.photo or first_msg_in_album.video
-            is_doc_album = first_msg_in_album.document
-            is_current_msg_pv = msg.photo or msg.video
-            
-            if (is_pv_album and not is_current_msg_pv) or \
-               (is_doc_album and is_current_msg_pv) or \
-               (len(current_album_messages) >= MAX_ALBUM_SIZE):
-                is_new_album = True
-
-        if is_new_album and current_album_messages:
-            all_albums_to_send.append({"messages": current_album_messages})
-            current_album_messages = []
-        
-        current_album_messages.append(msg)
-        
-    if current_album_messages:
-        all_albums_to_send.append({"messages": current_album_messages})
-
-    # --- 2. Relay the generated albums ---
-    final_recipients = [r for r in recipients if r['user_id'] != sender_id]
-    recipient_batches = [final_recipients[i:i + RELAY_BATCH_SIZE] for i in range(0, len(final_recipients), RELAY_BATCH_SIZE)]
-    
-    for i, batch in enumerate(recipient_batches):
-        for recipient in batch:
-            for album_data in all_albums_to_send:
-                original_msgs = album_data["messages"]
-                album_input_media = _create_album_from_messages(original_msgs)
-                
-                if not album_input_media: continue
-                try:
-                    reply_to_msg_id = None
-                    if original_msgs[0].reply_to_message:
-                        msg_map = await db.get_relayed_message_info_by_relayed_id(
-                            sender_id, original_msgs[0].reply_to_message.message_id
-                        ) or await db.get_relayed_message_info_by_original_id(original_msgs[0].reply_to_message.message_id)
-                        
-                        if msg_map and str(recipient['user_id']) in msg_map.get('relayed_to', {}):
-                            reply_to_msg_id = msg_map['relayed_to'][str(recipient['user_id'])]
-
-                    sent_messages = await context.bot.send_media_group(
-                        chat_id=recipient['user_id'], media=album_input_media,
-                        reply_to_message_id=reply_to_msg_id,
-                        read_timeout=60, connect_timeout=60
-                    )
-                    
-                    relayed_to_map = {str(recipient['user_id']): msg.message_id for msg in sent_messages}
-                    for j, original_msg in enumerate(original_msgs):
-                        await db.log_relayed_message(original_msg.message_id, sender_id, {str(recipient['user_id']): sent_messages[j].message_id})
-
-                except Forbidden:
-                    await db.update_user_status(recipient['user_id'], 'inactive')
-                except Exception as e:
-                    logger.error(f"Failed album send to {recipient['user_id']}: {e}")
-        
-        if len(recipient_batches) > 1: await asyncio.sleep(RELAY_BATCH_DELAY)
-    
-    await db.increment_user_stat(sender_id, media_count=len(messages))
-    logger.info(f"Finished relaying buffer for user {sender_id}")
-
-async def dispatch_media_processing(context: ContextTypes.DEFAULT_TYPE):
+    # Kept for inspection but not reported as slow: a relay to every user takes as long as the fan-out.
+    with tracing.trace(f"media relay from {sender_id}", slow_after=None):
+        recipients = await db.get_active_user_ids()
+        recipient_ids = [user_id for user_id in recipients if user_id != sender_id]
+
+        # Render the buffered messages into albums once, then persist the delivery before releasing the buffer.
+        with tracing.span('render', 'albums'):
+            albums = render_albums(messages)
+        message_ids = [msg.message_id for msg in messages]
+        job = None
+        if albums and recipient_ids:
+            job = await outbox.enqueue(
+                'album', sender_id, {'albums': [album.to_dict() for album in albums]}, recipient_ids,
+                source_message_ids=message_ids
+            )
+        await outbox.unbuffer_messages(sender_id, message_ids)
+        await db.increment_user_stat(sender_id, media_count=len(messages))
+
+        if job:
+            await _run_outbox_job(messages[0].get_bot(), job)
+        logger.info(f"Finished relaying buffer for user {sender_id}")
+
+media_dispatcher = MediaDispatcher(_relay_media)
+media_groups = MediaGroupAssembler(lambda sender_id, messages: media_dispatcher.add(sender_id, messages, complete=True))
+
+async def _run_outbox_job(bot: Bot, job: outbox.OutboxJob):
+    """Delivers an outbox job to its remaining recipients, checkpointing progress as it goes."""
+    checkpoints = asyncio.create_task(job.run_checkpoints())
+    try:
+        with lane('media' if job.kind == 'album' else 'text'), tracing.span('relay', f"{job.kind} fan-out"):
+            if job.kind == 'album':
+                await _deliver_albums(bot, job)
+            else:
+                await _deliver_text(bot, job)
+    finally:
+        checkpoints.cancel()
+        await job.checkpoint()
+    await job.complete()
+
+async def _deliver_albums(bot: Bot, job: outbox.OutboxJob):
+    albums = [AlbumPayload.from_dict(album) for album in job.payload['albums']]
+    reply_targets = [await _resolve_reply_targets(job.sender_id, album.reply_to_message_id) for album in albums]
+
+    recipients = job.pending
+    if sharding.use_shards(len(recipients)):
+        recipients = await _deliver_sharded(bot, job, reply_targets)
+
+    async def deliver(recipient_id: int):
+        for index in range(job.start_index(recipient_id), len(albums)):
+            album = albums[index]
+            sent_ids = await album.send(bot, recipient_id, reply_targets[index].get(recipient_id))
+            for item, sent_id in zip(album.items, sent_ids):
+                await db.log_relayed_message(item.original_message_id, job.sender_id, {str(recipient_id): sent_id}, album.group_id)
+            job.mark_progress(recipient_id, index + 1)
+        job.mark_done(recipient_id)
+
+    await fan_out(recipients, deliver, label=f"album relay from {job.sender_id}", flow=job.sender_id)
+    await db.flush_relay_log()
+
+async def _deliver_text(bot: Bot, job: outbox.OutboxJob):
+    payload = TextPayload.from_dict(job.payload)
+    reply_targets = await _resolve_reply_targets(job.sender_id, payload.reply_to_message_id)
+    recipients = job.pending
+    if sharding.use_shards(len(recipients)):
+        recipients = await _deliver_sharded(bot, job, [reply_targets])
+
+    async def deliver(recipient_id: int):
+        sent_id = await payload.send(bot, recipient_id, reply_targets.get(recipient_id))
+        await db.log_relayed_message(payload.message_id, job.sender_id, {str(recipient_id): sent_id})
+        job.mark_done(recipient_id)
+
+    await fan_out(recipients, deliver, label=f"text relay from {job.sender_id}", flow=job.sender_id)
+    await db.flush_relay_log()
+
+async def _deliver_sharded(bot: Bot, job: outbox.OutboxJob, reply_targets: List[Dict[int, int]]) -> List[int]:
     """
-    This is the dispatcher job. It runs every X seconds, checks the buffer,
-    and schedules one-off worker jobs for each user with pending media.
-    This function itself must be very fast.
+    Hands the job to the delivery shards, leaving them their share of the
+    global rate meanwhile. Deliveries are logged and marked in the outbox as
+    the shards report them, so checkpoints keep up while they run.
+    Returns the recipients of shards that failed and did not receive everything,
+    for the caller to deliver in this process.
     """
-    if not MEDIA_BUFFER: return
-    
-    buffer_copy = MEDIA_BUFFER.copy()
-    MEDIA_BUFFER.clear()
-    
-    for sender_id, messages in buffer_copy.items():
-        if messages:
-            context.job_queue.run_once(
-                _send_user_media_job,
-                when=1,
-                data={"sender_id": sender_id, "messages": messages},
-                name=f"send_media_{sender_id}_{datetime.now().timestamp()}"
-            )
-
-
-def _create_album_from_messages(messages: List[Message]) -> List:
-    if not messages: return []
-    caption = next((msg.caption for msg in messages if msg.caption), None)
-    album = []
-    
-    first_msg = messages[0]
-    if first_msg.photo: album.append(InputMediaPhoto(media=first_msg.photo[-1].file_id, caption=caption))
-    elif first_msg.video: album.append(InputMediaVideo(media=first_msg.video.file_id, caption=caption))
-    elif first_msg.document: album.append(InputMediaDocument(media=first_msg.document.file_id, caption=caption))
-
-    for msg in messages[1:]:
-        if msg.photo: album.append(InputMediaPhoto(media=msg.photo[-1].file_id))
-        elif msg.video: album.append(InputMediaVideo(media=msg.video.file_id))
-        elif msg.document: album.append(InputMediaDocument(media=msg.document.file_id))
-            
-    return album
+    start_indexes = {int(recipient_id): parts for recipient_id, parts in job.progress.items()}
+    group_ids = {}
+    if job.kind == 'album':
+        for album in job.payload['albums']:
+            album = AlbumPayload.from_dict(album)
+            group_ids.update((original_msg_id, album.group_id) for original_msg_id in album.original_message_ids)
+    started = time.monotonic()
+    sent = failed = 0
+    done, failed_shards = set(), set()
+    with bot.rate_limiter.reserve(sharding.SHARD_RATE_SHARE):
+        async for shard, event, data in sharding.shard_pool.deliver(
+            job.kind, job.sender_id, job.payload, job.pending, reply_targets, start_indexes
+        ):
+            if event == 'sent':
+                recipient_id, parts_sent, relayed = data
+                for original_msg_id, sent_id in relayed.items():
+                    await db.log_relayed_message(original_msg_id, job.sender_id, {str(recipient_id): sent_id},
+                                                 group_ids.get(original_msg_id))
+                if parts_sent is not None:
+                    job.mark_progress(recipient_id, parts_sent)
+            elif event == 'done':
+                done.add(data[0])
+                job.mark_done(data[0])
+            elif event == 'result':
+                summary = data[0]
+                if summary['forbidden']:
+                    await db.deactivate_users(summary['forbidden'])
+                sent += summary['sent']
+                failed += summary['failed']
+            else:
+                failed_shards.add(shard)
+                logger.error(f"Delivery shard {shard} failed on {job.kind} relay from {job.sender_id}: {data[0]}")
+    await db.flush_relay_log()
+    elapsed = time.monotonic() - started
+    logger.info(f"Sharded fan-out '{job.kind} relay from {job.sender_id}': {sent}/{len(job.pending)} sent, "
+                f"{failed} failed in {elapsed:.2f}s ({sent / elapsed if elapsed else 0:.1f}/s)")
+    remaining = [recipient_id for recipient_id in job.pending
+                 if recipient_id not in done and sharding.shard_for(recipient_id, sharding.shard_pool.shards) in failed_shards]
+    if remaining:
+        logger.warning(f"Delivering {job.kind} relay from {job.sender_id} to {len(remaining)} recipients of failed shards here.")
+    return remaining
+
+async def resume_pending_deliveries(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs once at startup: restores media that was buffered but not yet dispatched,
+    and resumes every outbox job that was interrupted by a restart.
+    """
+    jobs = await outbox.pending_jobs()
+    already_queued = {(job.sender_id, message_id) for job in jobs for message_id in job.source_message_ids}
+    buffered = await outbox.load_buffered_messages(context.bot)
+    for sender_id, messages in buffered.items():
+        media_dispatcher.add(sender_id, [msg for msg in messages if (sender_id, msg.message_id) not in already_queued])
+    for job in jobs:
+        context.job_queue.run_once(
+            lambda ctx, job=job: _run_outbox_job(ctx.bot, job),
+            when=0, name=f"resume_outbox_{job.id}"
+        )
+    if buffered or jobs:
+        logger.info(f"Restored buffered media for {len(buffered)} users and resumed {len(jobs)} deliveries.")
+
+async def _resolve_reply_targets(sender_id: int, reply_to_message_id: Optional[int]) -> Dict[int, int]:
+    """
+    Looks up the message being replied to once and returns, for every chat,
+    the ID of that chat's copy to reply to.
+    """
+    if not reply_to_message_id:
+        return {}
+    with tracing.span('reply', 'resolve'):
+        msg_map = await db.get_relayed_message_info_by_relayed_id(sender_id, reply_to_message_id)
+    if not msg_map:
+        return {}
+    reply_targets = {int(chat_id): msg_id for chat_id, msg_id in msg_map.get('relayed_to', {}).items()}
+    # The author of the replied-to message sees their own original, not a relayed copy.
+    reply_targets[msg_map['sender_id']] = msg_map['original_message_id']
+    return reply_targets
 
 
 async def _relay_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sender = update.effective_user
-    recipients = await db.get_all_active_users()
-    relayed_message_ids = {}
-
-    for recipient in recipients:
-        if recipient['user_id'] == sender.id: continue
-        try:
-            reply_to_msg_id = None
-            if update.message.reply_to_message:
-                msg_map = await db.get_relayed_message_info_by_relayed_id(
-                    sender.id, update.message.reply_to_message.message_id
-                ) or await db.get_relayed_message_info_by_original_id(update.message.reply_to_message.message_id)
-
-                if msg_map and str(recipient['user_id']) in msg_map.get('relayed_to', {}):
-                    reply_to_msg_id = msg_map['relayed_to'][str(recipient['user_id'])]
-            
-            sent_msg = None
-            if update.message.text:
-                text_to_send = f"<b>From: {sender.full_name}</b>\n\n{update.message.text_html}"
-                sent_msg = await context.bot.send_message(
-                    chat_id=recipient['user_id'], text=text_to_send, reply_to_message_id=reply_to_msg_id
-                )
-            else:
-                sent_msg = await context.bot.copy_message(
-                    chat_id=recipient['user_id'], from_chat_id=sender.id,
-                    message_id=update.message.message_id, reply_to_message_id=reply_to_msg_id
-                )
-            
-            if sent_msg:
-                relayed_message_ids[str(recipient['user_id'])] = sent_msg.message_id
-            await asyncio.sleep(0.05)
-        except Forbidden:
-            await db.update_user_status(recipient['user_id'], 'inactive')
-        except Exception as e:
-            logger.error(f"Failed relaying text to {recipient['user_id']}: {e}")
-
-    if relayed_message_ids:
-        await db.log_relayed_message(update.message.message_id, sender.id, relayed_message_ids)
+    recipients = await db.get_active_user_ids()
+    recipient_ids = [user_id for user_id in recipients if user_id != sender.id]
+
+    payload = render_text(update.message, sender.full_name)
+    if recipient_ids:
+        job = await outbox.enqueue('text', sender.id, payload.to_dict(), recipient_ids)
+        await _run_outbox_job(context.bot, job)
     await db.increment_user_stat(sender.id, message_count=1)
 
 @user_is_active
@@ -185,24 +196,11 @@ async def media_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     await db.update_last_active(update.effective_user.id)
     
     if update.message.media_group_id:
-        if not context.bot_data.get(update.message.media_group_id):
-            context.bot_data[update.message.media_group_id] = []
-        context.bot_data[update.message.media_group_id].append(update.message)
-
-        if update.message.media_group_id not in PROCESSED_MEDIA_GROUPS:
-            PROCESSED_MEDIA_GROUPS.add(update.message.media_group_id)
-            context.job_queue.run_once(
-                lambda ctx: _add_media_group_to_buffer(ctx, update.message.media_group_id, update.effective_user.id),
-                when=2, name=f"buffer_group_{update.message.media_group_id}"
-            )
+        await outbox.buffer_message(update.message)
+        media_groups.add(update.message)
     elif update.message.photo or update.message.video or update.message.document:
-        MEDIA_BUFFER[update.effective_user.id].append(update.message)
+        await outbox.buffer_message(update.message)
+        media_dispatcher.add(update.effective_user.id, [update.message])
     else:
         await _relay_text_message(update, context)
 
-async def _add_media_group_to_buffer(context: ContextTypes.DEFAULT_TYPE, media_group_id: str, user_id: int):
-    messages = context.bot_data.pop(media_group_id, [])
-    if messages:
-        MEDIA_BUFFER[user_id].extend(messages)
-    PROCESSED_MEDIA_GROUPS.discard(media_group_id)
-
@@ -0,0 +1,109 @@
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+# Upper bound on cached (chat, relayed message) pairs across all entries.
+RECENT_INDEX_MAX_MAPPINGS = int(os.getenv("RECENT_INDEX_MAX_MAPPINGS", 200000))
+
+
+class RecentMessageIndex:
+    """
+    LRU index of recently relayed messages, keyed both by (sender, original
+    message ID) and by (chat, relayed message ID). Memory is bounded by the total number
+    of relayed copies held, not by the number of messages.
+
+    Entries built only from copies logged by this process may be missing
+    copies sent before a restart. They are kept as partial: they resolve
+    origins, but get() reports them as misses until put() loads the full entry.
+    """
+
+    def __init__(self, max_mappings: int = RECENT_INDEX_MAX_MAPPINGS):
+        self.max_mappings = max_mappings
+        self._entries: "OrderedDict[Tuple[int, int], dict]" = OrderedDict()
+        self._by_relayed: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        self._partial: Set[Tuple[int, int]] = set()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, original_msg_id: int, sender_id: int, relayed_to: dict):
+        """Adds newly relayed copies to an entry, creating a partial one if needed."""
+        key = (sender_id, original_msg_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {
+                'original_message_id': original_msg_id, 'sender_id': sender_id, 'relayed_to': {}
+            }
+            self._by_relayed[key] = key
+            self._partial.add(key)
+        else:
+            self._entries.move_to_end(key)
+        for chat_id, msg_id in relayed_to.items():
+            if int(chat_id) not in entry['relayed_to']:
+                self._size += 1
+            entry['relayed_to'][int(chat_id)] = msg_id
+            self._by_relayed[(int(chat_id), msg_id)] = key
+        self._evict()
+
+    def put(self, message_log: dict):
+        """
+        Caches a complete log entry loaded from the database. Copies already
+        held for it are kept: they may have been logged while the entry was
+        being loaded and missed by the read.
+        """
+        key = (message_log['sender_id'], message_log['original_message_id'])
+        existing = self._entries.get(key)
+        relayed_to = dict(message_log.get('relayed_to', {}))
+        if existing is not None:
+            for chat_id, msg_id in existing['relayed_to'].items():
+                relayed_to.setdefault(chat_id, msg_id)
+        self.discard(*key)
+        self.record(message_log['original_message_id'], message_log['sender_id'], relayed_to)
+        self._partial.discard(key)
+
+    def get(self, sender_id: int, original_msg_id: int, partial: bool = False) -> Optional[dict]:
+        """Returns the cached entry. Partial entries are only returned with `partial=True`."""
+        key = (sender_id, original_msg_id)
+        entry = self._entries.get(key)
+        if entry is None or (not partial and key in self._partial):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_by_relayed(self, chat_id: int, message_id: int) -> Optional[dict]:
+        """
+        Finds an entry by any copy of the message, including the original in
+        the sender's chat. May be partial: use it to resolve the origin only.
+        """
+        key = self._by_relayed.get((chat_id, message_id))
+        if key is None:
+            self.misses += 1
+            return None
+        return self.get(*key, partial=True)
+
+    def discard(self, sender_id: int, original_msg_id: int):
+        key = (sender_id, original_msg_id)
+        entry = self._entries.pop(key, None)
+        self._partial.discard(key)
+        if entry:
+            self._drop_relayed(key, entry)
+
+    def _drop_relayed(self, key: Tuple[int, int], entry: dict):
+        for relayed_key in [key, *entry['relayed_to'].items()]:
+            if self._by_relayed.get(relayed_key) == key:
+                del self._by_relayed[relayed_key]
+        self._size -= len(entry['relayed_to'])
+
+    def _evict(self):
+        while self._size > self.max_mappings and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._partial.discard(key)
+            self._drop_relayed(key, entry)
+
+
+recent_messages = RecentMessageIndex()
@@ -0,0 +1,185 @@
+import time
+import logging
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, List, Sequence, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Tuple, le: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels):
+        """For counters kept elsewhere (e.g. a Counter in another module) and copied in at scrape time."""
+        self._values[labels] = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket..., count above the last bucket], sum.
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def totals(self) -> Dict[Tuple, Tuple[int, float]]:
+        """(count, sum) per label set."""
+        return {labels: (sum(counts), total[0]) for labels, (counts, total) in self._values.items()}
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, bound)} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, '+Inf')} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+UPDATES = Counter("relay_updates_total", "Updates received, by type.", ["type"])
+FANOUT_DURATION = Histogram("relay_fanout_duration_seconds", "Duration of whole fan-outs, by lane.", ["lane"],
+                            buckets=DURATION_BUCKETS)
+SEND_LATENCY = Histogram("relay_send_seconds", "Time to deliver to one recipient inside a fan-out, "
+                                               "including slot and rate limit waits, by lane.", ["lane"])
+SEND_OUTCOMES = Counter("relay_sends_total", "Fan-out deliveries by lane and outcome.", ["lane", "outcome"])
+SEND_FAILURES = Counter("relay_send_failures_total", "Failed fan-out deliveries by reason.", ["reason"])
+# Copied from the rate limiter at scrape time.
+API_REQUESTS = Counter("telegram_api_requests_total", "Throttled Bot API requests, by lane.", ["lane"])
+API_WAIT = Counter("telegram_api_rate_limit_wait_seconds_total", "Time requests waited for the rate limiter.", ["lane"])
+API_ERRORS = Counter("telegram_api_errors_total", "Bot API errors by exception class.", ["error"])
+DB_LATENCY = Histogram("relay_db_operation_seconds", "Duration of db.py operations that reach MongoDB.", ["operation"])
+DB_ERRORS = Counter("relay_db_operation_errors_total", "Failed db.py operations that reach MongoDB.", ["operation"])
+JOB_DURATION = Histogram("relay_job_duration_seconds", "Runtime of scheduled jobs.", ["job"], buckets=DURATION_BUCKETS)
+JOB_FAILURES = Counter("relay_job_failures_total", "Scheduled job runs that raised.", ["job"])
+# State of other components, also copied at scrape time.
+MEDIA_BUFFER = Gauge("relay_media_buffer", "Media waiting to be relayed.", ["unit"])
+MEDIA_GROUPS = Gauge("relay_media_groups_open", "Albums being assembled.", ["unit"])
+MEDIA_GROUPS_SPLIT = Counter("relay_media_groups_split_total", "Albums relayed in two parts because a part came late.")
+SCHEDULER = Gauge("relay_scheduler", "Fair scheduler state.", ["state"])
+CACHE_HIT_RATIO = Gauge("relay_cache_hit_ratio", "Hit ratio of in-memory caches since startup.", ["cache"])
+ACTIVE_USERS = Gauge("relay_active_users", "Users in the active roster.")
+BROADCASTS_RUNNING = Gauge("relay_broadcasts_running", "Broadcasts running in this process.")
+LOOP_LAG = Histogram("relay_event_loop_lag_seconds", "How late the event loop woke up a timer.",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+def timed(histogram: Histogram, failures: Counter, stage: str, name: str = None):
+    """
+    Records the duration of every call to an async function, and the calls
+    that raised. Calls are also added as spans to the current trace.
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                failures.inc(label)
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                histogram.observe(elapsed, label)
+                tracing.record(stage, label, started, elapsed)
+        return wrapped
+    return decorator
+
+
+def db_operation(func):
+    """For db.py functions that talk to MongoDB. In-memory fast paths stay undecorated."""
+    return timed(DB_LATENCY, DB_ERRORS, 'db')(func)
+
+
+def scheduled_job(func):
+    return timed(JOB_DURATION, JOB_FAILURES, 'job')(func)
+
+
+def update_type(update: Update) -> str:
+    if update.callback_query:
+        return 'callback_query'
+    message = update.effective_message
+    if message is None:
+        return 'other'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    if message.media_group_id:
+        return 'album_part'
+    if message.photo or message.video or message.document:
+        return 'media'
+    if message.text:
+        return 'text'
+    return 'other'
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    UPDATES.inc(update_type(update))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
@@ -0,0 +1,110 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from bson import ObjectId
+from telegram import Bot, Message
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CHECKPOINT_INTERVAL = float(os.getenv("OUTBOX_CHECKPOINT_INTERVAL", 1))
+
+
+class OutboxJob:
+    """
+    One persisted fan-out: a rendered payload plus the recipients still waiting for it.
+    Progress is tracked per recipient and per album, and checkpointed to MongoDB
+    while the job runs, so a restart resumes from the last checkpoint.
+    """
+
+    def __init__(self, doc: dict):
+        self.id: ObjectId = doc['_id']
+        self.kind: str = doc['kind']
+        self.sender_id: int = doc['sender_id']
+        self.payload: dict = doc['payload']
+        self.pending: List[int] = doc['pending']
+        self.progress: Dict[str, int] = doc.get('progress', {})
+        self.source_message_ids: List[int] = doc.get('source_message_ids', [])
+        self._done: List[int] = []
+        self._progress_updates: Dict[str, int] = {}
+
+    def start_index(self, recipient_id: int) -> int:
+        """How many parts of the payload this recipient already received."""
+        return self.progress.get(str(recipient_id), 0)
+
+    def mark_progress(self, recipient_id: int, parts_sent: int):
+        self.progress[str(recipient_id)] = parts_sent
+        self._progress_updates[str(recipient_id)] = parts_sent
+
+    def mark_done(self, recipient_id: int):
+        self._done.append(recipient_id)
+        self._progress_updates.pop(str(recipient_id), None)
+
+    async def checkpoint(self):
+        done, self._done = self._done, []
+        progress, self._progress_updates = self._progress_updates, {}
+        update = {}
+        if done:
+            update['$pullAll'] = {'pending': done}
+            update['$unset'] = {f'progress.{recipient_id}': '' for recipient_id in done}
+        if progress:
+            update['$set'] = {f'progress.{recipient_id}': parts for recipient_id, parts in progress.items()}
+        if update:
+            await db.db.outbox.update_one({'_id': self.id}, update)
+
+    async def run_checkpoints(self):
+        while True:
+            await asyncio.sleep(OUTBOX_CHECKPOINT_INTERVAL)
+            try:
+                await asyncio.shield(self.checkpoint())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox checkpoint for job {self.id} failed: {e}")
+
+    async def complete(self):
+        await db.db.outbox.delete_one({'_id': self.id})
+
+
+async def enqueue(kind: str, sender_id: int, payload: dict, recipients: Iterable[int],
+                  source_message_ids: List[int] = None) -> OutboxJob:
+    """
+    Persists a new delivery. `source_message_ids` names the buffered messages it was
+    rendered from, so they are not dispatched a second time after a restart.
+    """
+    doc = {
+        '_id': ObjectId(), 'kind': kind, 'sender_id': sender_id, 'payload': payload,
+        'pending': list(recipients), 'progress': {}, 'created_at': datetime.utcnow(),
+        'source_message_ids': source_message_ids or [],
+    }
+    await db.db.outbox.insert_one(doc)
+    return OutboxJob(doc)
+
+
+async def pending_jobs() -> List[OutboxJob]:
+    docs = await db.db.outbox.find({}).sort('created_at', 1).to_list(length=None)
+    return [OutboxJob(doc) for doc in docs]
+
+
+async def buffer_message(message: Message):
+    """Persists an incoming media message until it has been handed to an outbox job."""
+    await db.db.media_buffer.update_one(
+        {'sender_id': message.chat_id, 'message_id': message.message_id},
+        {'$setOnInsert': {'message': message.to_dict(), 'received_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+async def unbuffer_messages(sender_id: int, message_ids: List[int]):
+    await db.db.media_buffer.delete_many({'sender_id': sender_id, 'message_id': {'$in': message_ids}})
+
+
+async def load_buffered_messages(bot: Bot) -> Dict[int, List[Message]]:
+    buffered: Dict[int, List[Message]] = {}
+    async for doc in db.db.media_buffer.find({}).sort('received_at', 1):
+        buffered.setdefault(doc['sender_id'], []).append(Message.de_json(doc['message'], bot))
+    return buffered
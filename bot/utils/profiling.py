@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+from typing import Optional, Tuple
+
+from .metrics import LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+# How often the event loop is checked for stalls.
+LOOP_MONITOR_INTERVAL = 0.1
+# A loop that has not run for this long is reported together with the code that blocks it.
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", 0.25))
+# Bounds for /profile.
+PROFILE_MAX_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag with a heartbeat task. A watchdog thread notices
+    when the heartbeat stops and logs the loop thread's stack at that moment,
+    which points at the code blocking the loop.
+    """
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_LAG_WARN_SECONDS):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._beat = now
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop lagged {lag:.3f}s.")
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval / 2):
+            beat = self._beat
+            if time.monotonic() - beat < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable"
+            logger.warning(f"Event loop blocked for over {self.threshold}s, currently in:\n{stack}")
+
+
+def _sample(thread_id: int, seconds: float, interval: float) -> Tuple[Counter, int]:
+    stacks: Counter = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+            samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+async def sample_profile(seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL) -> Tuple[str, int, list]:
+    """
+    Samples the event loop thread's stack for `seconds` from a helper thread
+    while the bot keeps running. Returns the samples in collapsed-stack format
+    (for flamegraph.pl or speedscope), the sample count, and the functions
+    seen most often at the top of the stack.
+    """
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    stacks, samples = await asyncio.to_thread(_sample, threading.get_ident(), seconds, interval)
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    leaves: Counter = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return collapsed + "\n", samples, leaves.most_common(5)
+
+
+loop_monitor = LoopMonitor()
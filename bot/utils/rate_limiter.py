@@ -0,0 +1,272 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Deque, Dict, Optional, Union, List
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages per second overall and about one per second per private chat.
+GLOBAL_RATE = float(os.getenv("RELAY_GLOBAL_RATE", 30))
+PER_CHAT_RATE = float(os.getenv("RELAY_PER_CHAT_RATE", 1))
+PER_CHAT_BURST = int(os.getenv("RELAY_PER_CHAT_BURST", 3))
+UNTHROTTLED_ENDPOINTS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "answerCallbackQuery"}
+# How often a request is retried after RetryAfter before the error is passed on to the caller.
+# Sends inside fan_out are not retried here: fan_out re-queues them with backoff.
+MAX_RETRY_AFTER_RETRIES = int(os.getenv("RELAY_MAX_RETRY_AFTER_RETRIES", 2))
+# If this many different chats are flood-limited within the window, the whole bot is paused.
+GLOBAL_FLOOD_CHATS = 3
+GLOBAL_FLOOD_WINDOW = 5.0
+
+# Outbound traffic classes, most urgent first. When requests of several lanes
+# wait for a token, the most urgent lane is served first, so replies and
+# approvals overtake relays, and relays overtake broadcasts.
+LANES = {'interactive': 0, 'text': 1, 'media': 2, 'bulk': 3}
+# Bulk sends never use more than this share of the global rate, keeping the
+# rest free for the other lanes even while a broadcast is running.
+BULK_RATE_SHARE = float(os.getenv("RELAY_BULK_RATE_SHARE", 0.8))
+
+# The lane of requests made by the current task. Tasks inherit it from the code that created them.
+current_lane: ContextVar[str] = ContextVar('current_lane', default='interactive')
+# Set by callers that re-queue flood-limited sends themselves (fan_out). Their
+# requests are not retried here, so a flood wait never holds their worker.
+caller_retries: ContextVar[bool] = ContextVar('caller_retries', default=False)
+
+
+@contextmanager
+def lane(name: str):
+    """Sends made inside this block (and tasks started from it) use the given lane."""
+    token = current_lane.set(name)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class TokenBucket:
+    """
+    A simple asyncio token bucket. Waiters with a lower priority number are
+    served first, waiters of the same priority in FIFO order.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues: Dict[int, Deque[asyncio.Future]] = {}
+        self._waiting = 0
+        self._pump: Optional[asyncio.Task] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    @property
+    def is_idle(self) -> bool:
+        """True once the bucket has refilled completely and nobody is waiting on it."""
+        self._refill()
+        return self._tokens >= self.capacity and not self._waiting and self._paused_until < time.monotonic()
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+        self.capacity = max(1, int(rate))
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        """Hands out no tokens for `seconds`, e.g. while Telegram's flood wait is in effect."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 0.0
+
+    def _take(self) -> bool:
+        if self._paused_until > time.monotonic():
+            return False
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: int = 0):
+        if not self._waiting and self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(priority, deque()).append(future)
+        self._waiting += 1
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._tokens += 1
+            raise
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue:
+                future = queue.popleft()
+                self._waiting -= 1
+                if not future.done():
+                    return future
+            del self._queues[priority]
+        return None
+
+    async def _run_pump(self):
+        """Hands out tokens to waiters, most urgent first, until nobody is waiting."""
+        while self._waiting:
+            paused_for = self._paused_until - time.monotonic()
+            if paused_for > 0:
+                await asyncio.sleep(paused_for)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                future = self._next_waiter()
+                if future is None:
+                    break
+                self._tokens -= 1
+                future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RelayRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Throttles every Bot API request made through the application.
+    A request first waits for its chat's bucket, then for the global bucket,
+    so a busy chat never holds up deliveries to other chats.
+    On RetryAfter the affected chat is paused for the requested time (or the
+    whole bot, when several chats are flood-limited at once). The request is
+    then retried here, or the error is raised at once when the caller retries
+    itself (see `caller_retries`). Requests are classified into LANES by `rate_limit_args={'lane': ...}`
+    or, by default, by the current `lane()` block.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 per_chat_burst: int = PER_CHAT_BURST):
+        self._global_rate = global_rate
+        self._reservations = 0
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._bulk = TokenBucket(global_rate * BULK_RATE_SHARE, max(1, int(global_rate * BULK_RATE_SHARE)))
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._recent_floods = deque()
+        self.requests_made = 0
+        self.retry_after_count = 0
+        self.lane_requests: Counter = Counter()
+        self.lane_wait: Counter = Counter()
+        self.api_errors: Counter = Counter()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    @contextmanager
+    def reserve(self, share: float):
+        """
+        Leaves `share` of the global rate to another process (the delivery
+        shards) while the block runs. Overlapping reservations of the same
+        share are counted, and the full rate returns with the last one.
+        """
+        self._reservations += 1
+        if self._reservations == 1:
+            rate = max(self._global_rate * (1 - share), 1.0)
+            self._global.set_rate(rate)
+            self._bulk.set_rate(min(self._global_rate * BULK_RATE_SHARE, rate))
+        try:
+            yield
+        finally:
+            self._reservations -= 1
+            if self._reservations == 0:
+                self._global.set_rate(self._global_rate)
+                self._bulk.set_rate(self._global_rate * BULK_RATE_SHARE)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._prune()
+            bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, self._per_chat_burst)
+        return bucket
+
+    def _prune(self):
+        for chat_id in [c for c, b in self._chats.items() if b.is_idle]:
+            del self._chats[chat_id]
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        if endpoint in UNTHROTTLED_ENDPOINTS:
+            self.requests_made += 1
+            try:
+                with tracing.span('telegram', endpoint):
+                    return await callback(*args, **kwargs)
+            except Exception as e:
+                self.api_errors[type(e).__name__] += 1
+                raise
+
+        chat_id = data.get("chat_id")
+        lane_name = (rate_limit_args or {}).get('lane') or current_lane.get()
+        priority = LANES.get(lane_name, 0)
+        retries = 0 if caller_retries.get() else MAX_RETRY_AFTER_RETRIES
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire(priority)
+            if lane_name == 'bulk':
+                await self._bulk.acquire()
+            await self._global.acquire(priority)
+            self.requests_made += 1
+            waited = time.monotonic() - started
+            self.lane_requests[lane_name] += 1
+            self.lane_wait[lane_name] += waited
+            tracing.record('rate_limit', endpoint, started, waited)
+            try:
+                with tracing.span('telegram', endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_count += 1
+                self.api_errors['RetryAfter'] += 1
+                self._on_flood(chat_id, e.retry_after)
+                if attempt == retries:
+                    raise
+                logger.warning(f"Flood control on {endpoint} for chat {chat_id}: retrying in {e.retry_after}s.")
+            except Exception as e:
+                self.api_errors[type(e).__name__] += 1
+                raise
+
+    def _on_flood(self, chat_id: Optional[Union[int, str]], retry_after):
+        seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+        now = time.monotonic()
+        self._recent_floods.append((now, chat_id))
+        while self._recent_floods and self._recent_floods[0][0] < now - GLOBAL_FLOOD_WINDOW:
+            self._recent_floods.popleft()
+        flooded_chats = {c for _, c in self._recent_floods}
+        if chat_id is None or len(flooded_chats) >= GLOBAL_FLOOD_CHATS:
+            logger.warning(f"Flood control across {len(flooded_chats)} chats: pausing all sends for {seconds}s.")
+            self._global.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from pymongo import DeleteMany, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# A message is identified by the chat it lives in and its ID within that chat:
+# Telegram message IDs are only unique per chat.
+MessageKey = Tuple[int, int]
+
+
+def mapping_ops(sender_id: int, original_msg_id: int, relayed_to: dict, now: datetime,
+                group_id: Optional[int] = None) -> list:
+    """
+    Upserts for the relay_map collection: one small document per relayed copy,
+    plus one for the original in the sender's chat, so any message the bot
+    knows about resolves with a single indexed lookup. Items relayed as one
+    album share a group_id (the original ID of the album's first item).
+    """
+    copies = {int(chat_id): msg_id for chat_id, msg_id in relayed_to.items()}
+    copies[sender_id] = original_msg_id
+    fields = {'sender_id': sender_id, 'original_message_id': original_msg_id, 'timestamp': now}
+    if group_id is not None:
+        fields['group_id'] = group_id
+    return [
+        UpdateOne({'chat_id': chat_id, 'message_id': msg_id}, {'$set': fields}, upsert=True)
+        for chat_id, msg_id in copies.items()
+    ]
+
+
+class RelayLogWriter:
+    """
+    Collects relay mappings in memory and writes them to MongoDB as a single
+    bulk_write. Entries stay visible to lookups while they are pending or
+    being flushed, so replies and /delete work before the write lands.
+    """
+
+    def __init__(self):
+        self._pending: Dict[MessageKey, dict] = {}
+        self._inflight: Dict[MessageKey, dict] = {}
+        self._by_relayed: Dict[MessageKey, MessageKey] = {}
+        self._groups: Dict[MessageKey, int] = {}
+        self._deleted_during_flush = set()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, original_msg_id: int, sender_id: int, relayed_to: dict, group_id: Optional[int] = None):
+        key = (sender_id, original_msg_id)
+        entry = self._pending.setdefault(key, {})
+        if group_id is not None:
+            self._groups[key] = group_id
+        self._by_relayed[key] = key
+        for chat_id, msg_id in relayed_to.items():
+            entry[int(chat_id)] = msg_id
+            self._by_relayed[(int(chat_id), msg_id)] = key
+
+    def get(self, sender_id: int, original_msg_id: int) -> Optional[dict]:
+        """Returns the not-yet-persisted copies of a message as {chat_id: message_id}, if any."""
+        key = (sender_id, original_msg_id)
+        inflight, pending = self._inflight.get(key), self._pending.get(key)
+        if inflight is None and pending is None:
+            return None
+        return {**(inflight or {}), **(pending or {})}
+
+    def original_for_relayed(self, chat_id: int, message_id: int) -> Optional[MessageKey]:
+        """Returns (sender_id, original_message_id) for a copy or original that is not yet persisted."""
+        return self._by_relayed.get((chat_id, message_id))
+
+    def discard(self, sender_id: int, original_msg_id: int):
+        key = (sender_id, original_msg_id)
+        entry = self._pending.pop(key, None)
+        if entry is not None:
+            self._by_relayed.pop(key, None)
+            self._groups.pop(key, None)
+            for chat_id, msg_id in entry.items():
+                self._by_relayed.pop((chat_id, msg_id), None)
+        if key in self._inflight:
+            self._deleted_during_flush.add(key)
+
+    async def flush(self, collection):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            now = datetime.utcnow()
+            ops = [
+                op
+                for key, copies in self._inflight.items()
+                for op in mapping_ops(*key, copies, now, self._groups.get(key))
+            ]
+            try:
+                await collection.bulk_write(ops, ordered=False)
+            except Exception as e:
+                logger.error(f"Relay log flush of {len(ops)} mappings failed, will retry: {e}")
+                for key, copies in self._inflight.items():
+                    if key not in self._deleted_during_flush:
+                        self._pending[key] = {**copies, **self._pending.get(key, {})}
+            else:
+                for key, copies in self._inflight.items():
+                    pending = self._pending.get(key)
+                    if pending is None:
+                        self._by_relayed.pop(key, None)
+                        self._groups.pop(key, None)
+                    for chat_id, msg_id in copies.items():
+                        if (pending or {}).get(chat_id) != msg_id and self._by_relayed.get((chat_id, msg_id)) == key:
+                            del self._by_relayed[(chat_id, msg_id)]
+                if self._deleted_during_flush:
+                    await collection.bulk_write([
+                        DeleteMany({'sender_id': sender_id, 'original_message_id': original_msg_id})
+                        for sender_id, original_msg_id in self._deleted_during_flush
+                    ], ordered=False)
+            finally:
+                self._inflight = {}
+                self._deleted_during_flush.clear()
+
+    async def run(self, collection, interval: float):
+        """Flushes on a timer so entries never wait long for persistence."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.shield(self.flush(collection))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Periodic relay log flush failed: {e}")
+
+
+relay_log_writer = RelayLogWriter()
@@ -0,0 +1,142 @@
+from html import escape
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional, Tuple
+
+from telegram import Bot, Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+
+MAX_ALBUM_SIZE = 10
+_INPUT_MEDIA_TYPES = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+
+
+@dataclass(frozen=True)
+class MediaItem:
+    kind: str
+    file_id: str
+    original_message_id: int
+
+
+@dataclass(frozen=True)
+class AlbumPayload:
+    """One ready-to-send album. `input_media` is built once and reused for every recipient."""
+    items: Tuple[MediaItem, ...]
+    caption: Optional[str] = None
+    reply_to_message_id: Optional[int] = None
+    input_media: tuple = field(default=(), compare=False, repr=False)
+
+    @classmethod
+    def build(cls, items: Tuple[MediaItem, ...], caption: Optional[str], reply_to_message_id: Optional[int]):
+        input_media = tuple(
+            _INPUT_MEDIA_TYPES[item.kind](media=item.file_id, caption=caption if i == 0 else None)
+            for i, item in enumerate(items)
+        )
+        return cls(items, caption, reply_to_message_id, input_media)
+
+    @property
+    def original_message_ids(self) -> Tuple[int, ...]:
+        return tuple(item.original_message_id for item in self.items)
+
+    @property
+    def group_id(self) -> int:
+        """Identifies the album in the relay log: the original ID of its first item."""
+        return self.items[0].original_message_id
+
+    async def send(self, bot: Bot, chat_id: int, reply_to_message_id: Optional[int] = None) -> List[int]:
+        """Sends the album to one chat and returns the IDs of the sent messages, item by item."""
+        sent_messages = await bot.send_media_group(
+            chat_id=chat_id, media=self.input_media, reply_to_message_id=reply_to_message_id,
+            read_timeout=60, connect_timeout=60
+        )
+        return [msg.message_id for msg in sent_messages]
+
+    def to_dict(self) -> dict:
+        return {'items': [asdict(item) for item in self.items], 'caption': self.caption,
+                'reply_to_message_id': self.reply_to_message_id}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "AlbumPayload":
+        items = tuple(MediaItem(**item) for item in data['items'])
+        return cls.build(items, data.get('caption'), data.get('reply_to_message_id'))
+
+
+@dataclass(frozen=True)
+class TextPayload:
+    """A relayed non-media message. Text is sent as pre-rendered HTML; anything else is copied."""
+    from_chat_id: int
+    message_id: int
+    html: Optional[str] = None
+    reply_to_message_id: Optional[int] = None
+
+    async def send(self, bot: Bot, chat_id: int, reply_to_message_id: Optional[int] = None) -> int:
+        """Sends the message to one chat and returns the ID of the sent copy."""
+        if self.html:
+            sent_msg = await bot.send_message(chat_id=chat_id, text=self.html, reply_to_message_id=reply_to_message_id)
+        else:
+            sent_msg = await bot.copy_message(
+                chat_id=chat_id, from_chat_id=self.from_chat_id,
+                message_id=self.message_id, reply_to_message_id=reply_to_message_id
+            )
+        return sent_msg.message_id
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TextPayload":
+        return cls(**data)
+
+
+def _media_item(msg: Message) -> Optional[MediaItem]:
+    if msg.photo: return MediaItem('photo', msg.photo[-1].file_id, msg.message_id)
+    if msg.video: return MediaItem('video', msg.video.file_id, msg.message_id)
+    if msg.document: return MediaItem('document', msg.document.file_id, msg.message_id)
+    return None
+
+
+def _group_messages(messages: List[Message]) -> List[List[Message]]:
+    """Splits messages into albums, preserving order. Photos and videos can share an album; documents cannot."""
+    albums: List[List[Message]] = []
+    current_album_messages: List[Message] = []
+
+    for msg in messages:
+        is_new_album = False
+        if not current_album_messages:
+            is_new_album = True
+        else:
+            first_msg_in_album = current_album_messages[0]
+            is_pv_album = first_msg_in_album.photo or first_msg_in_album.video
+            is_doc_album = first_msg_in_album.document
+            is_current_msg_pv = msg.photo or msg.video
+
+            if (is_pv_album and not is_current_msg_pv) or \
+               (is_doc_album and is_current_msg_pv) or \
+               (len(current_album_messages) >= MAX_ALBUM_SIZE):
+                is_new_album = True
+
+        if is_new_album and current_album_messages:
+            albums.append(current_album_messages)
+            current_album_messages = []
+
+        current_album_messages.append(msg)
+
+    if current_album_messages:
+        albums.append(current_album_messages)
+    return albums
+
+
+def render_albums(messages: List[Message]) -> Tuple[AlbumPayload, ...]:
+    """Turns a sender's buffered media messages into ready-to-send album payloads."""
+    payloads = []
+    for album_messages in _group_messages(messages):
+        items = tuple(item for item in map(_media_item, album_messages) if item)
+        if not items:
+            continue
+        caption = next((msg.caption_html for msg in album_messages if msg.caption), None)
+        reply_to = album_messages[0].reply_to_message
+        payloads.append(AlbumPayload.build(items, caption, reply_to.message_id if reply_to else None))
+    return tuple(payloads)
+
+
+def render_text(message: Message, sender_name: str) -> TextPayload:
+    reply_to = message.reply_to_message
+    html = f"<b>From: {escape(sender_name)}</b>\n\n{message.text_html}" if message.text else None
+    return TextPayload(message.chat_id, message.message_id, html, reply_to.message_id if reply_to else None)
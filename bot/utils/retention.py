@@ -0,0 +1,101 @@
+import os
+import gzip
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from bson import json_util
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Relay mappings older than this are removed. 0 keeps them forever.
+RELAY_LOG_RETENTION_DAYS = float(os.getenv("RELAY_LOG_RETENTION_DAYS", 30))
+# When set, expired mappings are exported to gzipped JSON Lines files here before deletion.
+RELAY_LOG_ARCHIVE_DIR = os.getenv("RELAY_LOG_ARCHIVE_DIR", "")
+# Mappings per archive file. Each file is closed before its entries are deleted.
+ARCHIVE_CHUNK_SIZE = 50000
+
+TTL_INDEX_NAME = "timestamp_ttl"
+# Plain index used by archive_expired() when the TTL index is not in place.
+ARCHIVE_INDEX_NAME = "timestamp_archive"
+
+
+async def ensure_relay_log_retention(collection):
+    """
+    Keeps the TTL index on relay_map in line with the configuration. With an
+    archive directory the index is replaced by a plain one on the same field,
+    and archive_expired() deletes entries instead, so nothing expires before
+    it has been exported.
+    """
+    indexes = await collection.index_information()
+    current = indexes.get(TTL_INDEX_NAME, {}).get('expireAfterSeconds')
+    archiving = bool(RELAY_LOG_ARCHIVE_DIR) and RELAY_LOG_RETENTION_DAYS > 0
+    wanted = int(RELAY_LOG_RETENTION_DAYS * 86400) if RELAY_LOG_RETENTION_DAYS > 0 and not archiving else None
+
+    # MongoDB rejects two indexes on the same key with different options,
+    # so the one that is not wanted is dropped before the other is created.
+    if not archiving and ARCHIVE_INDEX_NAME in indexes:
+        await collection.drop_index(ARCHIVE_INDEX_NAME)
+    if wanted is None:
+        if TTL_INDEX_NAME in indexes:
+            await collection.drop_index(TTL_INDEX_NAME)
+            logger.info("Removed the relay log TTL index.")
+        if archiving and ARCHIVE_INDEX_NAME not in indexes:
+            await collection.create_index("timestamp", name=ARCHIVE_INDEX_NAME)
+        return
+    if current == wanted:
+        return
+    if TTL_INDEX_NAME in indexes:
+        try:
+            await collection.database.command(
+                'collMod', collection.name, index={'name': TTL_INDEX_NAME, 'expireAfterSeconds': wanted}
+            )
+        except OperationFailure as e:
+            logger.warning(f"collMod of the relay log TTL index failed ({e}), recreating it.")
+            await collection.drop_index(TTL_INDEX_NAME)
+            await collection.create_index("timestamp", name=TTL_INDEX_NAME, expireAfterSeconds=wanted)
+    else:
+        await collection.create_index("timestamp", name=TTL_INDEX_NAME, expireAfterSeconds=wanted)
+    logger.info(f"Relay logs now expire after {RELAY_LOG_RETENTION_DAYS:g} days.")
+
+
+def _write_archive(path: str, docs: List[dict]):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for doc in docs:
+            f.write(json_util.dumps(doc))
+            f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def archive_expired(collection, archive_dir: str = RELAY_LOG_ARCHIVE_DIR,
+                          retention_days: float = RELAY_LOG_RETENTION_DAYS) -> dict:
+    """
+    Exports relay mappings older than the retention period to
+    <archive_dir>/relay_map-<cutoff>-<n>.jsonl.gz and deletes them once the
+    file is on disk. Returns what was archived.
+    """
+    if not archive_dir or retention_days <= 0:
+        return {'archived': 0, 'files': []}
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    stamp = cutoff.strftime('%Y%m%dT%H%M%S')
+    archived, files = 0, []
+
+    while True:
+        docs = await collection.find({'timestamp': {'$lt': cutoff}}).sort('timestamp', 1).limit(ARCHIVE_CHUNK_SIZE).to_list(None)
+        if not docs:
+            break
+        path = os.path.join(archive_dir, f"relay_map-{stamp}-{len(files)}.jsonl.gz")
+        await asyncio.to_thread(_write_archive, path, docs)
+        await collection.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        archived += len(docs)
+        files.append(path)
+        if len(docs) < ARCHIVE_CHUNK_SIZE:
+            break
+
+    if archived:
+        logger.info(f"Archived {archived} relay log entries older than {cutoff:%Y-%m-%d} to {len(files)} file(s).")
+    return {'archived': archived, 'files': files}
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+
+class ActiveRoster:
+    """
+    In-memory, sorted int64 array of active user IDs.
+    The array is replaced on every change (copy-on-write), so a snapshot
+    handed to a fan-out never changes underneath it.
+    """
+
+    def __init__(self):
+        self._ids = array('q')
+        self.loaded = False
+        self._load_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def snapshot(self) -> array:
+        return self._ids
+
+    async def load(self, users_collection):
+        async with self._load_lock:
+            ids = array('q')
+            async for doc in users_collection.find({'status': 'active'}, {'user_id': 1, '_id': 0}):
+                ids.append(doc['user_id'])
+            self._ids = array('q', sorted(ids))
+            self.loaded = True
+        logger.info(f"Active roster loaded with {len(self._ids)} users.")
+
+    def add(self, user_id: int):
+        i = bisect_left(self._ids, user_id)
+        if i < len(self._ids) and self._ids[i] == user_id:
+            return
+        ids = array('q', self._ids)
+        ids.insert(i, user_id)
+        self._ids = ids
+
+    def discard(self, user_id: int):
+        i = bisect_left(self._ids, user_id)
+        if i < len(self._ids) and self._ids[i] == user_id:
+            ids = array('q', self._ids)
+            del ids[i]
+            self._ids = ids
+
+    def discard_many(self, user_ids):
+        """Removes many users with a single copy, for bulk status changes."""
+        drop = set(user_ids)
+        if drop:
+            self._ids = array('q', (user_id for user_id in self._ids if user_id not in drop))
+
+    def apply_status(self, user_id: int, status: str):
+        if status == 'active':
+            self.add(user_id)
+        else:
+            self.discard(user_id)
+
+    async def watch(self, users_collection):
+        """
+        Follows a MongoDB change stream so status writes made by other
+        instances reach this roster too. Requires a replica set (e.g. Atlas).
+        """
+        pipeline = [{'$match': {'$or': [
+            {'operationType': {'$in': ['insert', 'replace', 'delete']}},
+            {'updateDescription.updatedFields.status': {'$exists': True}},
+        ]}}]
+        while True:
+            try:
+                async with users_collection.watch(pipeline, full_document='updateLookup') as stream:
+                    await self.load(users_collection)
+                    async for change in stream:
+                        doc = change.get('fullDocument')
+                        if change['operationType'] == 'delete' or not doc:
+                            await self.load(users_collection)
+                        else:
+                            self.apply_status(doc['user_id'], doc.get('status'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Roster change stream interrupted: {e}. Reconnecting in 10s.")
+                await asyncio.sleep(10)
+
+
+active_roster = ActiveRoster()
@@ -0,0 +1,169 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, List, Set
+
+logger = logging.getLogger(__name__)
+
+# Relay sends in flight at once, shared by all senders. Slots are handed out
+# round-robin across senders, so this is the budget they compete for.
+RELAY_SEND_SLOTS = int(os.getenv("RELAY_SEND_SLOTS", 32))
+# Sends a sender may start per round. Raise a sender's weight to give it more.
+RELAY_QUANTUM = 1.0
+# Senders whose wait statistics are kept after their queue drained.
+FLOW_STATS_LIMIT = 1000
+
+
+class _Waiter:
+    __slots__ = ('future', 'cost', 'enqueued')
+
+    def __init__(self, future: asyncio.Future, cost: float):
+        self.future = future
+        self.cost = cost
+        self.enqueued = time.monotonic()
+
+
+class _FlowStats:
+    __slots__ = ('granted', 'wait_total', 'wait_max', 'last_wait')
+
+    def __init__(self):
+        self.granted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_wait = 0.0
+
+
+class FairScheduler:
+    """
+    Shares a fixed number of send slots between flows (senders) with deficit
+    round-robin: every flow with waiting sends gets `quantum * weight` worth
+    of sends per round, so a sender with thousands of queued sends cannot
+    delay a sender with a few. Flows without competition are not slowed down.
+    Must be used from the event loop.
+    """
+
+    def __init__(self, slots: int = RELAY_SEND_SLOTS, quantum: float = RELAY_QUANTUM):
+        self.slots = slots
+        self.quantum = quantum
+        self.weights: Dict[Hashable, float] = {}
+        self._free = slots
+        self._queues: Dict[Hashable, Deque[_Waiter]] = {}
+        self._active: Deque[Hashable] = deque()
+        self._deficit: Dict[Hashable, float] = {}
+        self._topped_up: Set[Hashable] = set()
+        self._in_flight: Counter = Counter()
+        self.backlog: Counter = Counter()
+        self._flows: "OrderedDict[Hashable, _FlowStats]" = OrderedDict()
+        self.waits = deque(maxlen=1000)
+
+    @asynccontextmanager
+    async def slot(self, flow: Hashable, cost: float = 1.0):
+        """Holds one of the shared slots for the duration of a send on behalf of `flow`."""
+        if self._free > 0 and not self._active:
+            self._free -= 1
+            self._record(flow, 0.0)
+        else:
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), cost)
+            if flow not in self._queues:
+                self._queues[flow] = deque()
+                self._active.append(flow)
+            self._queues[flow].append(waiter)
+            self._grant()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Granted just as we were cancelled: pass the slot on.
+                    self._done(flow)
+                raise
+        try:
+            yield
+        finally:
+            self._done(flow)
+
+    def _record(self, flow: Hashable, wait: float):
+        self._in_flight[flow] += 1
+        stats = self._flows.get(flow)
+        if stats is None:
+            stats = self._flows[flow] = _FlowStats()
+            while len(self._flows) > FLOW_STATS_LIMIT:
+                self._flows.popitem(last=False)
+        else:
+            self._flows.move_to_end(flow)
+        stats.granted += 1
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+        stats.last_wait = wait
+        self.waits.append(wait)
+
+    def _done(self, flow: Hashable):
+        self._in_flight[flow] -= 1
+        if self._in_flight[flow] <= 0:
+            del self._in_flight[flow]
+        self._free += 1
+        self._grant()
+
+    def _grant(self):
+        while self._free > 0 and self._active:
+            flow = self._active[0]
+            queue = self._queues[flow]
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                self._active.popleft()
+                del self._queues[flow]
+                self._deficit.pop(flow, None)
+                self._topped_up.discard(flow)
+                continue
+            if flow not in self._topped_up:
+                self._deficit[flow] = self._deficit.get(flow, 0.0) + self.quantum * self.weights.get(flow, 1.0)
+                self._topped_up.add(flow)
+            waiter = queue[0]
+            if self._deficit[flow] >= waiter.cost:
+                queue.popleft()
+                self._deficit[flow] -= waiter.cost
+                self._free -= 1
+                self._record(flow, time.monotonic() - waiter.enqueued)
+                waiter.future.set_result(None)
+            else:
+                # This flow used its share of the round: move on to the next one.
+                self._topped_up.discard(flow)
+                self._active.rotate(-1)
+
+    def flows(self, limit: int = 10) -> List[dict]:
+        """Senders with queued or running sends, the most backlogged first."""
+        now = time.monotonic()
+        keys = set(self.backlog) | set(self._queues) | set(self._in_flight)
+        rows = []
+        for flow in keys:
+            queue = self._queues.get(flow) or ()
+            stats = self._flows.get(flow)
+            rows.append({
+                'flow': flow,
+                'backlog': self.backlog.get(flow, 0),
+                'waiting': len(queue),
+                'in_flight': self._in_flight.get(flow, 0),
+                'oldest_wait': now - queue[0].enqueued if queue else 0.0,
+                'avg_wait': stats.wait_total / stats.granted if stats and stats.granted else 0.0,
+                'max_wait': stats.wait_max if stats else 0.0,
+            })
+        rows.sort(key=lambda row: (-row['backlog'], -row['waiting']))
+        return rows[:limit]
+
+    def stats(self) -> Dict[str, float]:
+        waits = sorted(self.waits)
+        return {
+            'slots': self.slots,
+            'slots_in_use': self.slots - self._free,
+            'flows_waiting': len(self._active),
+            'sends_waiting': sum(len(queue) for queue in self._queues.values()),
+            'backlog': sum(self.backlog.values()),
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0,
+        }
+
+
+relay_scheduler = FairScheduler()
@@ -0,0 +1,238 @@
+import os
+import asyncio
+import logging
+import threading
+import itertools
+import multiprocessing
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from telegram.constants import ParseMode
+from telegram.ext import Defaults, ExtBot
+
+from .delivery import fan_out
+from .rate_limiter import GLOBAL_RATE, RelayRateLimiter, lane
+from .render import AlbumPayload, TextPayload
+
+logger = logging.getLogger(__name__)
+
+# Number of delivery worker processes. 0 or 1 keeps all delivery on the main event loop.
+DELIVERY_SHARDS = int(os.getenv("DELIVERY_SHARDS", 0))
+# Fan-outs smaller than this are not worth the inter-process round trip.
+SHARD_MIN_RECIPIENTS = int(os.getenv("SHARD_MIN_RECIPIENTS", 200))
+# Share of the global send rate given to the shards, split evenly between them. While
+# they deliver, the main process keeps only the rest, so the bot stays within GLOBAL_RATE.
+SHARD_RATE_SHARE = float(os.getenv("SHARD_RATE_SHARE", 0.8))
+# How often a delivery waiting on shards checks that their processes are still alive.
+SHARD_LIVENESS_INTERVAL = 1.0
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    """Stable partition of a chat, so every send to it goes through the same process and rate limiter."""
+    return chat_id % shards
+
+
+def partition(chat_ids, shards: int) -> List[List[int]]:
+    partitions: List[List[int]] = [[] for _ in range(shards)]
+    for chat_id in chat_ids:
+        partitions[shard_for(chat_id, shards)].append(chat_id)
+    return partitions
+
+
+async def deliver_partition(bot, kind: str, sender_id: int, payload: dict, recipients: List[int],
+                            reply_targets: list, start_indexes: Dict[int, int],
+                            report: Callable[..., None]) -> dict:
+    """
+    Delivers a serialized payload to one partition of recipients. Every
+    delivery is passed to `report` as soon as it happens, as plain data that
+    can cross a process boundary:
+    report('sent', recipient_id, parts_sent, {original_message_id: sent_id}) per message or album
+    (parts_sent is None for text), then report('done', recipient_id).
+    Returns a summary of the outcome.
+    """
+    if kind == 'album':
+        albums = [AlbumPayload.from_dict(album) for album in payload['albums']]
+
+        async def deliver(recipient_id: int):
+            for index in range(start_indexes.get(recipient_id, 0), len(albums)):
+                album = albums[index]
+                sent_ids = await album.send(bot, recipient_id, reply_targets[index].get(recipient_id))
+                report('sent', recipient_id, index + 1,
+                       {item.original_message_id: sent_id for item, sent_id in zip(album.items, sent_ids)})
+            report('done', recipient_id)
+    else:
+        text = TextPayload.from_dict(payload)
+
+        async def deliver(recipient_id: int):
+            sent_id = await text.send(bot, recipient_id, reply_targets[0].get(recipient_id))
+            report('sent', recipient_id, None, {text.message_id: sent_id})
+            report('done', recipient_id)
+
+    with lane('media' if kind == 'album' else 'text'):
+        result = await fan_out(recipients, deliver, label=f"{kind} relay from {sender_id} (shard)",
+                               demote_forbidden=False, flow=sender_id)
+    return {
+        'forbidden': result.forbidden, 'sent': result.sent, 'failed': result.failed,
+        'failures': dict(result.failures), 'elapsed': result.elapsed,
+    }
+
+
+def _shard_main(index: int, bot_token: str, base_url: Optional[str], global_rate: float, tasks, results):
+    logging.basicConfig(format=f'%(asctime)s - shard{index} - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(_shard_loop(bot_token, base_url, global_rate, tasks, results))
+
+
+async def _shard_loop(bot_token: str, base_url: Optional[str], global_rate: float, tasks, results):
+    extra = {'base_url': base_url} if base_url else {}
+    bot = ExtBot(bot_token, defaults=Defaults(parse_mode=ParseMode.HTML),
+                 rate_limiter=RelayRateLimiter(global_rate=global_rate), **extra)
+    await bot.initialize()
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    async def run(task_id: int, args: tuple):
+        def report(event: str, *data):
+            results.put((task_id, event, data))
+        try:
+            results.put((task_id, 'result', (await deliver_partition(bot, *args, report=report),)))
+        except Exception as e:
+            results.put((task_id, 'error', (f"{type(e).__name__}: {e}",)))
+
+    while True:
+        task = await loop.run_in_executor(None, tasks.get)
+        if task is None:
+            break
+        job = asyncio.create_task(run(*task))
+        running.add(job)
+        job.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+    await bot.shutdown()
+
+
+class ShardPool:
+    """
+    N delivery processes, each with its own event loop, Bot and rate limiter.
+    Shard i always receives partition i of the recipients, and runs several
+    partitions concurrently. `global_rate` is split evenly between shards; the
+    caller reserves it in its own rate limiter while a delivery runs.
+    Lanes and sender fairness only apply within each process.
+    """
+
+    def __init__(self, shards: int, bot_token: str, base_url: Optional[str] = None,
+                 global_rate: float = GLOBAL_RATE * SHARD_RATE_SHARE):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self._args = (bot_token, base_url, global_rate / shards)
+        self._results = self._ctx.Queue()
+        self._tasks = [self._ctx.Queue() for _ in range(shards)]
+        self._processes = [self._spawn(i) for i in range(shards)]
+        self._streams: Dict[int, Tuple[int, asyncio.Queue]] = {}
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+
+    def _spawn(self, index: int):
+        return self._ctx.Process(target=_shard_main, args=(index, *self._args, self._tasks[index], self._results),
+                                 daemon=True, name=f"delivery-shard-{index}")
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for process in self._processes:
+            process.start()
+        self._reader = threading.Thread(target=self._read_results, daemon=True, name="shard-results")
+        self._reader.start()
+        logger.info(f"Started {self.shards} delivery shards.")
+
+    def _restart(self, index: int):
+        """Replaces a dead shard. Tasks queued for the old one are dropped: their callers were told it failed."""
+        logger.error(f"Delivery shard {index} exited with code {self._processes[index].exitcode}, restarting it.")
+        self._tasks[index] = self._ctx.Queue()
+        self._processes[index] = self._spawn(index)
+        self._processes[index].start()
+
+    def _read_results(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._dispatch, *message)
+
+    def _dispatch(self, task_id: int, event: str, data: tuple):
+        stream = self._streams.get(task_id)
+        if stream is None:
+            return
+        if event in ('result', 'error'):
+            del self._streams[task_id]
+        shard, events = stream
+        events.put_nowait((task_id, shard, event, data))
+
+    async def deliver(self, kind: str, sender_id: int, payload: dict, recipients: List[int],
+                      reply_targets: list, start_indexes: Dict[int, int]) -> AsyncIterator[Tuple[int, str, tuple]]:
+        """
+        Hands each partition to its shard and yields (shard, event, data) while
+        they deliver: the 'sent' and 'done' events of deliver_partition, then
+        one final 'result' (the summary) or 'error' (a message) per shard. A
+        shard whose process died is reported as an 'error' and restarted.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        # The process each partition was handed to, so a restarted shard is not mistaken for it.
+        outstanding: Dict[int, Tuple[int, multiprocessing.Process]] = {}
+        for shard, part in enumerate(partition(recipients, self.shards)):
+            if not part:
+                continue
+            if not self._processes[shard].is_alive():
+                self._restart(shard)
+            task_id = next(self._ids)
+            self._streams[task_id] = (shard, events)
+            outstanding[task_id] = (shard, self._processes[shard])
+            starts = {chat_id: start_indexes[chat_id] for chat_id in part if chat_id in start_indexes}
+            self._tasks[shard].put((task_id, (kind, sender_id, payload, part, reply_targets, starts)))
+        try:
+            while outstanding:
+                try:
+                    task_id, shard, event, data = await asyncio.wait_for(events.get(), SHARD_LIVENESS_INTERVAL)
+                except asyncio.TimeoutError:
+                    for task_id, (shard, process) in list(outstanding.items()):
+                        if process.is_alive():
+                            continue
+                        del outstanding[task_id]
+                        self._streams.pop(task_id, None)
+                        if process is self._processes[shard]:
+                            self._restart(shard)
+                        yield shard, 'error', (f"shard process exited with code {process.exitcode}",)
+                    continue
+                if event in ('result', 'error'):
+                    outstanding.pop(task_id, None)
+                yield shard, event, data
+        finally:
+            for task_id in outstanding:
+                self._streams.pop(task_id, None)
+
+    async def stop(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [p.join(30) for p in self._processes])
+        self._results.put(None)
+        logger.info("Delivery shards stopped.")
+
+
+shard_pool: Optional[ShardPool] = None
+
+
+def start_shard_pool(bot_token: str, base_url: Optional[str] = None):
+    """Starts the delivery shards if DELIVERY_SHARDS > 1. Must be called from the running event loop."""
+    global shard_pool
+    if DELIVERY_SHARDS > 1 and shard_pool is None:
+        shard_pool = ShardPool(DELIVERY_SHARDS, bot_token, base_url)
+        shard_pool.start()
+
+
+async def stop_shard_pool():
+    global shard_pool
+    if shard_pool:
+        await shard_pool.stop()
+        shard_pool = None
+
+
+def use_shards(recipients: int) -> bool:
+    return shard_pool is not None and recipients >= SHARD_MIN_RECIPIENTS
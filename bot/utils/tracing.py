@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Finished traces kept in memory for /slow.
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 500))
+# Updates (and relays) taking longer than this are logged with a breakdown by stage.
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", 2.0))
+# Spans stored per trace. Time per stage is still counted beyond it.
+MAX_SPANS = 200
+
+
+class Trace:
+    """
+    The spans recorded while handling one update or relay. Spans of
+    concurrent work (e.g. fan-out sends) overlap, so the time per stage can
+    add up to more than the duration of the trace.
+    """
+
+    __slots__ = ('name', 'started_at', 'started', 'duration', 'spans', 'stages', 'dropped', 'error')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = 0.0
+        self.spans: List[Tuple[str, str, float, float]] = []
+        self.stages: Dict[str, List[float]] = {}
+        self.dropped = 0
+        self.error: Optional[str] = None
+
+    def add(self, stage: str, name: str, started: float, duration: float):
+        totals = self.stages.setdefault(stage, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((stage, name, started - self.started, duration))
+        else:
+            self.dropped += 1
+
+    def breakdown(self) -> str:
+        parts = [f"{stage} {seconds * 1000:.0f}ms/{count}" for stage, (count, seconds)
+                 in sorted(self.stages.items(), key=lambda item: -item[1][1])]
+        return ", ".join(parts) or "no spans"
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+TRACES: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+SLOW_TRACES: deque = deque(maxlen=50)
+
+
+@contextmanager
+def trace(name: str, slow_after: Optional[float] = SLOW_UPDATE_SECONDS):
+    """
+    Starts a new trace for the work done inside the block, including tasks
+    started from it. Traces longer than `slow_after` are logged as slow.
+    """
+    current = Trace(name)
+    token = current_trace.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current_trace.reset(token)
+        current.duration = time.monotonic() - current.started
+        TRACES.append(current)
+        if slow_after is not None and current.duration >= slow_after:
+            SLOW_TRACES.append(current)
+            logger.warning(f"Slow {current.name}: {current.duration:.2f}s ({current.breakdown()})")
+
+
+def record(stage: str, name: str, started: float, duration: float):
+    """Adds a finished span to the current trace, if there is one."""
+    current = current_trace.get()
+    if current is not None:
+        current.add(stage, name, started, duration)
+
+
+@contextmanager
+def span(stage: str, name: str):
+    """Times the block as a span of the current trace. Works around awaits too."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(stage, name, started, time.monotonic() - started)
+
+
+def update_name(update) -> str:
+    user = update.effective_user
+    if update.callback_query:
+        kind = f"callback {(update.callback_query.data or '').split('_', 1)[0]}"
+    elif update.effective_message and update.effective_message.text and update.effective_message.text.startswith('/'):
+        kind = f"command {update.effective_message.text.split()[0]}"
+    else:
+        kind = "message"
+    return f"update {update.update_id} ({kind} from {user.id if user else 'unknown'})"
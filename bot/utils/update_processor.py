@@ -0,0 +1,79 @@
+import asyncio
+import inspect
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# The base class's semaphore would also count updates waiting for their
+# chat's turn. It is sized so it never blocks; the real limit is applied after.
+_UNBOUNDED = 2 ** 31
+
+
+def _chat_key(update: object) -> Optional[Hashable]:
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, and the updates of one
+    chat one after another, in the order they arrived. Album parts and quick
+    successive messages from a sender are therefore handled in order.
+    Updates waiting for their chat's turn do not count against
+    `max_concurrent_updates`, so a busy chat cannot hold up the others.
+    """
+
+    __slots__ = ('_limit', '_slots', '_running', '_last')
+
+    def __init__(self, max_concurrent_updates: int):
+        self._limit = max_concurrent_updates
+        super().__init__(_UNBOUNDED)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._running = 0
+        # Completion of the latest update of each chat with one waiting or running.
+        self._last: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _chat_key(update)
+        previous = done = None
+        if key is not None:
+            previous = self._last.get(key)
+            done = self._last[key] = asyncio.get_running_loop().create_future()
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._slots:
+                self._running += 1
+                try:
+                    await coroutine
+                finally:
+                    self._running -= 1
+        except asyncio.CancelledError:
+            # Cancelled before its turn: the update's coroutine was never started.
+            if inspect.iscoroutine(coroutine):
+                coroutine.close()
+            raise
+        finally:
+            if done is not None:
+                done.set_result(None)
+                if self._last.get(key) is done:
+                    del self._last[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
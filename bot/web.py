@@ -0,0 +1,193 @@
+import json
+import asyncio
+import hmac
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+from .utils import metrics
+from .utils.auth_cache import auth_cache
+from .utils.broadcast import running as running_broadcasts
+from .utils.media_handler import media_dispatcher, media_groups
+from .utils.message_index import recent_messages
+from .utils.roster import active_roster
+from .utils.scheduler import relay_scheduler
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    body: bytes = b""
+
+
+@dataclass
+class Response:
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class WebServer:
+    """
+    A small HTTP/1.1 server running on the bot's own event loop.
+    It serves the health check and receives Telegram webhook updates, so no
+    separate web framework or thread is needed.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080, reuse_port: bool = False):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None
+        )
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return Response(400, b"Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > MAX_BODY_SIZE:
+            return Response(413, b"Payload too large")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method.upper(), target.split("?", 1)[0], headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self.routes)
+            return Response(405, b"Method not allowed") if known_path else Response(404, b"Not found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {e}", exc_info=True)
+            return Response(500, b"Internal server error")
+
+    async def _write_response(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+        await writer.drain()
+
+
+async def health_check(request: Request) -> Response:
+    """Provides a simple health check endpoint for deployment platforms."""
+    return Response(200, b"Relay bot is running.")
+
+
+def _collect_runtime_metrics(application: Application):
+    limiter = application.bot.rate_limiter
+    if limiter is not None:
+        for lane, count in limiter.lane_requests.items():
+            metrics.API_REQUESTS.set(count, lane)
+        for lane, seconds in limiter.lane_wait.items():
+            metrics.API_WAIT.set(seconds, lane)
+        for error, count in limiter.api_errors.items():
+            metrics.API_ERRORS.set(count, error)
+    buffered = media_dispatcher.stats()
+    metrics.MEDIA_BUFFER.set(buffered['buffered_items'], 'items')
+    metrics.MEDIA_BUFFER.set(buffered['buffered_senders'], 'senders')
+    groups = media_groups.stats()
+    metrics.MEDIA_GROUPS.set(groups['open_groups'], 'groups')
+    metrics.MEDIA_GROUPS.set(groups['open_parts'], 'parts')
+    metrics.MEDIA_GROUPS_SPLIT.set(groups['split'])
+    for state in ('slots_in_use', 'flows_waiting', 'sends_waiting', 'backlog'):
+        metrics.SCHEDULER.set(relay_scheduler.stats()[state], state)
+    for name, cache in (('auth', auth_cache), ('recent_messages', recent_messages)):
+        lookups = cache.hits + cache.misses
+        metrics.CACHE_HIT_RATIO.set(cache.hits / lookups if lookups else 0.0, name)
+    metrics.ACTIVE_USERS.set(len(active_roster))
+    metrics.BROADCASTS_RUNNING.set(len(running_broadcasts()))
+
+
+def metrics_handler(application: Application, token: str = "") -> Handler:
+    """
+    Builds the Prometheus scrape route. With a token, scrapers must send
+    `Authorization: Bearer <token>`.
+    """
+    async def serve_metrics(request: Request) -> Response:
+        if token and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+            return Response(401, b"Unauthorized")
+        _collect_runtime_metrics(application)
+        return Response(200, metrics.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+    return serve_metrics
+
+
+def webhook_handler(application: Application, secret_token: str) -> Handler:
+    """
+    Builds the Telegram webhook route. Updates are queued for the application
+    and acknowledged immediately, without waiting for handlers to finish.
+    """
+    async def receive_update(request: Request) -> Response:
+        received = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if secret_token and not hmac.compare_digest(received, secret_token):
+            return Response(403, b"Invalid secret token")
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return Response(400, b"Malformed update")
+        await application.update_queue.put(update)
+        return Response(200, b"")
+    return receive_update
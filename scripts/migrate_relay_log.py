@@ -0,0 +1,85 @@
+"""
+Moves relay logs from the old `messages` collection (one document per
+original message, holding every recipient) to `relay_map` (one small
+document per relayed copy).
+
+    python -m scripts.migrate_relay_log --batch-size 500 [--drop]
+
+MONGO_URI and MONGO_DB_NAME are read from the environment or .env. The
+migration is idempotent: mappings are upserted, so it can be interrupted and
+re-run, also while the bot is running. --drop removes the old collection
+once every document has been copied.
+
+The old documents do not record which album a message belonged to, so the
+migrated mappings carry no group_id: /delete on an album relayed before the
+migration removes only the item it is used on, and the other items have to
+be deleted one by one.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from bot.utils.relay_log import mapping_ops
+
+
+async def migrate(mongo_uri: str, db_name: str, batch_size: int, drop: bool):
+    client = AsyncIOMotorClient(mongo_uri)
+    try:
+        await _migrate(client[db_name], batch_size, drop)
+    finally:
+        client.close()
+
+
+async def _migrate(db, batch_size: int, drop: bool):
+    await db.relay_map.create_index([("chat_id", 1), ("message_id", 1)], unique=True)
+    await db.relay_map.create_index([("sender_id", 1), ("original_message_id", 1)])
+
+    migrated, mappings, skipped = 0, 0, 0
+    started = time.perf_counter()
+    ops = []
+    cursor = db.messages.find({}, {'_id': 0, 'relayed_to_flat': 0}, batch_size=batch_size)
+    async for doc in cursor:
+        if 'sender_id' not in doc or 'original_message_id' not in doc:
+            skipped += 1
+            continue
+        ops.extend(mapping_ops(doc['sender_id'], doc['original_message_id'], doc.get('relayed_to', {}),
+                               doc.get('timestamp') or datetime.utcnow()))
+        migrated += 1
+        if len(ops) >= batch_size:
+            await db.relay_map.bulk_write(ops, ordered=False)
+            mappings += len(ops)
+            ops = []
+    if ops:
+        await db.relay_map.bulk_write(ops, ordered=False)
+        mappings += len(ops)
+
+    if drop and not skipped:
+        await db.messages.drop()
+    print(json.dumps({
+        "messages": migrated,
+        "mappings": mappings,
+        "skipped": skipped,
+        "dropped_old_collection": drop and not skipped,
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500, help="mappings written per bulk_write")
+    parser.add_argument("--drop", action="store_true", help="drop the old messages collection afterwards")
+    args = parser.parse_args()
+
+    load_dotenv()
+    asyncio.run(migrate(os.environ["MONGO_URI"], os.getenv("MONGO_DB_NAME", "telegram_relay_bot"),
+                        args.batch_size, args.drop))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Posts recorded Telegram updates to a locally running bot, the way Telegram's
+webhook delivery would, and reports how quickly each one was acknowledged.
+
+    python scripts/replay_updates.py scripts/sample_updates.jsonl \
+        --url http://localhost:8080/telegram --secret "$WEBHOOK_SECRET"
+
+The input is a JSON array or one JSON update per line. Update IDs are
+rewritten to be unique, so the same file can be replayed repeatedly.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+
+def load_updates(path: str):
+    with open(path, encoding="utf-8") as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+async def replay(updates, url: str, secret: str, concurrency: int, repeat: int):
+    latencies, failures = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    base_id = int(time.time() * 1000)
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(index: int, update: dict):
+            nonlocal failures
+            update = {**update, "update_id": base_id + index}
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, json=update, headers=headers)
+                latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failures += 1
+                print(f"update {update['update_id']}: HTTP {response.status_code} {response.text}", file=sys.stderr)
+
+        batch = [update for _ in range(repeat) for update in updates]
+        started = time.perf_counter()
+        await asyncio.gather(*(post(i, update) for i, update in enumerate(batch)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(json.dumps({
+        "updates": len(batch),
+        "failures": failures,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(batch) / elapsed, 1) if elapsed else None,
+        "ack_p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else None,
+        "ack_p99_ms": round(latencies[int(len(latencies) * 0.99) - 1 if len(latencies) > 1 else 0] * 1000, 2) if latencies else None,
+    }, indent=2))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="JSON or JSONL file of recorded updates")
+    parser.add_argument("--url", default="http://localhost:8080/telegram")
+    parser.add_argument("--secret", default="", help="value of WEBHOOK_SECRET used by the bot")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="replay the file this many times")
+    args = parser.parse_args()
+
+    failures = asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.concurrency, args.repeat))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()